@@ -1,80 +1,132 @@
-from collections import defaultdict
-
 from argparse import ArgumentParser
-import json
+from itertools import groupby
+from operator import itemgetter
+import sys
 
 import pandas as pd
 from tqdm import tqdm
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_line(obj):
+        # the tables are keyed by (integer) corpus ids, which orjson only serializes with OPT_NON_STR_KEYS
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+# update progress bars at most once a second, and not at all when stderr isn't a terminal (e.g. logging to a file)
+TQDM_KWARGS = {"mininterval": 1.0, "smoothing": 0, "disable": not sys.stderr.isatty()}
+
+# outputs are written in 1 MiB chunks rather than the default 8 KiB
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def wrap_cell(cell):
+    # this is a silly formatting thing - table values are lists. not sure if we'll keep it or not
+    return cell if type(cell) is list else [cell]
+
+
+def rekey_table(table_dict, kept):
+    """
+    Builds the {column: {corpus_id: [value]}} table from `table_dict`, keeping only the rows in `kept`,
+    a list of (row, corpus_id) pairs. The "References" column becomes the corpus id keys.
+    """
+    # the corpus ids are unique after filtering, so each column can be zipped straight into a dict
+    rows = [row for row, _ in kept]
+    corpus_ids = [corpus_id for _, corpus_id in kept]
+    return {
+        col: dict(zip(corpus_ids, [wrap_cell(col_vals[row]) for row in rows]))
+        for col, col_vals in table_dict.items()
+        if col != "References"
+    }
+
+
+def rekey_table_pandas(table_dict, kept):
+    """The original pandas implementation of `rekey_table`. Kept for cross-checking the outputs."""
+    rows = [row for row, _ in kept]
+    df = pd.DataFrame(table_dict)
+    # set by integer position so the assignment doesn't go through label lookups
+    ref_col_idx = df.columns.get_loc("References")
+    df.iloc[rows, ref_col_idx] = [corpus_id for _, corpus_id in kept]
+    df = df.iloc[rows].set_index("References")
+    return df.map(wrap_cell).to_dict()
+
 
 def main():
     argp = ArgumentParser()
     argp.add_argument("in_tables_path", type=str)
     argp.add_argument("out_tables_path", type=str)
     argp.add_argument("out_papers_path", type=str)
+    argp.add_argument(
+        "--use_pandas", action="store_true", help="build the tables with pandas (slower, for checking outputs)"
+    )
     args = argp.parse_args()
+    loads, dumps_line = _loads, _dumps_line
 
-    with open(args.in_tables_path) as f:
-        in_tables = [json.loads(line.strip()) for line in f]
+    # (corpus_id, tabid) pairs for every cited paper. These are grouped into `bib_table_map` after the loop
+    paper_tabid_pairs = []
+    bib_entries = {}  # corpus_id -> (title, abstract)
 
-    bib_table_map = defaultdict(list)
-    bib_entries = {}
-
-    with open(args.out_tables_path, "w") as f:
-        for table in tqdm(in_tables):
+    # the input tables are parsed one line at a time rather than loaded into memory up front
+    with open(args.in_tables_path, "rb") as in_f, open(args.out_tables_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for line in tqdm(in_f, **TQDM_KWARGS):
+            table = loads(line)
             table_json = {}
             table_json["tabid"] = table["_table_hash"]
             if not table["table_json"]["table_dict"]:
                 print(f"Skipping {table['_table_hash']}")
                 continue
 
-            df = pd.DataFrame(table["table_json"]["table_dict"])
+            # a single pass over the row_bib_map collects the rows to keep, and the papers' table ids and info
+            kept = []
+            for row_entry in table["row_bib_map"]:
+                corpus_id = row_entry["corpus_id"]
+                paper_tabid_pairs.append((corpus_id, table["_table_hash"]))
+                if corpus_id != -1:
+                    kept.append((row_entry["row"], corpus_id))
+                    bib_entries[corpus_id] = (row_entry["title"], row_entry["abstract"])
+
             # rewrite the "References" to have the *corpus_ids* rather than the *bib_hash* prefixes or *arxiv_ids*
-            row_subset = []
-            for row in table["row_bib_map"]:
-                if row["corpus_id"] != -1:
-                    df["References"][row["row"]] = row["corpus_id"]
-                    row_subset.append(row["row"])
-            df = df.iloc[row_subset].set_index("References")
-
-            df = df.map(
-                lambda x: x if isinstance(x, list) else [x]
-            )  # this is a silly formatting thing - table values are lists. not sure if we'll keep it or not
-            table_json["table"] = df.to_dict()
+            if args.use_pandas:
+                table_json["table"] = rekey_table_pandas(table["table_json"]["table_dict"], kept)
+            else:
+                table_json["table"] = rekey_table(table["table_json"]["table_dict"], kept)
             table_json["row_bib_map"] = table["row_bib_map"]
-            for row_entry in table["row_bib_map"]:
-                bib_table_map[row_entry["corpus_id"]].append(table["_table_hash"])
-                if row_entry["corpus_id"] != -1:
-                    bib_entries[row_entry["corpus_id"]] = {
-                        "title": row_entry["title"],
-                        "abstract": row_entry["abstract"],
-                    }
             table_json["caption"] = table["caption"]
             table_json["in_text_ref"] = table["in_text_ref"]
             table_json["arxiv_id"] = table["paper_id"]
-            f.write(json.dumps(table_json) + "\n")
+            f.write(dumps_line(table_json))
 
     # papers.jsonl
+    # the sort only looks at the corpus ids (and is stable), so each paper's tabids stay in the order they were
+    # seen. Missing (`None`) corpus ids are sorted last rather than compared against the ints
+    paper_tabid_pairs.sort(key=lambda pair: (pair[0] is None, pair[0] or 0))
+    bib_table_map = {
+        corpus_id: [tabid for _, tabid in pairs] for corpus_id, pairs in groupby(paper_tabid_pairs, key=itemgetter(0))
+    }
 
     print()
-    with open(args.out_papers_path, "w") as f:
+    with open(args.out_papers_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
         num_skipped = 0
-        for corpus_id in tqdm(bib_table_map):
-            paper = {}
-            if corpus_id not in bib_entries:
-                continue
-            try:
-                paper["tabids"] = bib_table_map[corpus_id]
-                paper["corpus_id"] = corpus_id
-                paper["title"] = bib_entries[corpus_id]["title"]
-                paper["abstract"] = bib_entries[corpus_id]["abstract"]
-
-            except KeyError:
-                print(bib_entries[corpus_id].keys())
-            except AttributeError:
+        for corpus_id, tabids in tqdm(bib_table_map.items(), **TQDM_KWARGS):
+            entry = bib_entries.get(corpus_id)
+            if entry is None:
+                # e.g. rows without a corpus id (-1)
                 num_skipped += 1
                 continue
-            f.write(json.dumps(paper) + "\n")
+            title, abstract = entry
+            paper = {"tabids": tabids, "corpus_id": corpus_id, "title": title, "abstract": abstract}
+            f.write(dumps_line(paper))
         print(f"Num skipped papers: {num_skipped}")
 
 
@@ -1,25 +1,107 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
 import glob
 import gzip
-import json
+from itertools import islice
 import os
 from pathlib import Path
 import shutil
+import sys
+import threading
 import time
 import re
+
 from tqdm import tqdm
 
 
 import time
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
 
 DOWNLOAD_URL="" # contact the authors for the download url
+FLUSH_EVERY = 5  # number of downloaded papers between flushes of the output file
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 5
+
+# update progress bars at most once a second, and not at all when stderr isn't a terminal (e.g. logging to a file)
+TQDM_KWARGS = {"mininterval": 1.0, "smoothing": 0, "disable": not sys.stderr.isatty()}
+
+# pulls `metadata.corpusId` out of a raw output line without parsing the (large) full text. Only matches
+# if `corpusId` comes before any nested object in `metadata`; otherwise we fall back to parsing the line.
+METADATA_CORPUS_ID_RE = re.compile(rb'"metadata"\s*:\s*\{[^{}]*?"corpusId"\s*:\s*(-?\d+)')
+
+
+def get_downloaded_corpus_id(line):
+    match = METADATA_CORPUS_ID_RE.search(line)
+    if match is not None:
+        return int(match[1])
+    return _loads(line)["metadata"]["corpusId"]
 
-def save_jsons(jsons, out_file):
-    with open(out_file, "a") as f:
-        for sample in jsons:
-            f.write(json.dumps(sample) + "\n")
+
+class RateLimiter:
+    """Spaces out calls to `wait` (across threads) so that at most `rate` happen per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def get_retry_after(response, default=1.0):
+    try:
+        return float(response.headers.get("Retry-After", default))
+    except ValueError:
+        # Retry-After can also be an http date, which we don't bother parsing
+        return default
+
+
+def fetch_full_text(session, rate_limiter, corpus_id):
+    # only back off when the server is overloaded or rate-limiting us. Other responses (including
+    # errors like "CorpusId is not showable") are returned right away.
+    # Network errors and non-json responses (e.g. an html 502 page once the retries run out) are returned as
+    # errors too, rather than raised, so one bad paper doesn't stop the rest of the downloads.
+    try:
+        for _ in range(MAX_RETRIES):
+            rate_limiter.wait()
+            response = session.get(f"{DOWNLOAD_URL}{corpus_id}")
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+            time.sleep(get_retry_after(response))
+        return corpus_id, _loads(response.content)
+    except (requests.RequestException, ValueError) as e:
+        # ValueError covers both json's and orjson's decode errors
+        return corpus_id, {"error": {"type": type(e).__name__, "message": str(e)}}
+
+def save_jsons(jsons, f):
+    """Writes `jsons` as json lines to the already-open (binary) file `f`."""
+    if jsons:
+        f.write(b"".join(_dumps_line(sample) for sample in jsons))
 
 
 def main():
@@ -28,67 +110,74 @@ def main():
     argp.add_argument("--out_file")
     argp.add_argument("--start", type=int, default=0)
     argp.add_argument("--count", type=int, default=None)
+    argp.add_argument("--num_workers", type=int, default=16, help="number of concurrent requests")
+    argp.add_argument("--requests_per_second", type=float, default=2.0)
     args = argp.parse_args()
+    loads, dumps_line = _loads, _dumps_line
     print("starting")
 
-    data_jsons = []
-    with open(args.papers_file) as f:
-        papers = [json.loads(line) for line in f]
-
-    start = args.start
-    count = len(papers) - args.start if args.count is None else args.count
-    papers = papers[start : start + count]
+    # only parse the lines in [start, start + count)
+    stop = None if args.count is None else args.start + args.count
+    with open(args.papers_file, "rb") as f:
+        papers = [loads(line) for line in islice(f, args.start, stop)]
 
     # filter out corpus_ids that we've already downloaded
     try:
-        with open(args.out_file) as f:
-            obtained_corpus_ids = [json.loads(line)["metadata"]["corpusId"] for line in tqdm(f, total=2513)]
-            # obtained_corpus_ids = {paper["metadata"]["corpusId"] for paper in previous_papers}
-            assert obtained_corpus_ids
-            print(list(obtained_corpus_ids[:10]), len(obtained_corpus_ids))
+        with open(args.out_file, "rb") as f:
+            obtained_corpus_ids = {get_downloaded_corpus_id(line) for line in tqdm(f, **TQDM_KWARGS)}
+            print(f"Already downloaded {len(obtained_corpus_ids)} papers")
 
             papers = [paper for paper in papers if paper["corpus_id"] not in obtained_corpus_ids]
     except FileNotFoundError:
         pass
 
+    # reuse connections across requests and issue them from a pool of threads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=args.num_workers, pool_maxsize=args.num_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    rate_limiter = RateLimiter(args.requests_per_second)
+
     unshowable_corpus_ids = []
     other_error_corpus_ids = []
-    for sample in tqdm(papers):
-        corpus_id = sample["corpus_id"]
-
-        response = requests.get(f"{DOWNLOAD_URL}{corpus_id}")
-
-        data = response.json()
-
-        if "error" in data:
-            # print(f"Skipping {corpus_id} due to error:")
-            # print(data)
-            if isinstance(data["error"], str) and data["error"].startswith("CorpusId is not showable"):
-                unshowable_corpus_ids.append(corpus_id)
-            else:
-                other_error_corpus_ids.append(corpus_id)
-
-            time.sleep(0.1)
-            continue
-
-        if "metadata" not in data:
-            print(data.keys())
-            data["metadata"] = {"corpusId": corpus_id}
-        else:
-            data["metadata"]["corpusId"] = corpus_id
-
-        data_jsons.append(data)
-        if len(data_jsons) >= 5:
-            save_jsons(data_jsons, args.out_file)
-            data_jsons = []
-
-        time.sleep(0.5)
-
-    save_jsons(data_jsons, args.out_file)
-    save_jsons(
-        [{"unshowable_ids": unshowable_corpus_ids, "other_error_ids": other_error_corpus_ids}],
-        os.path.splitext(args.out_file)[0] + "_errors.jsonl",
-    )
+    num_saved = 0
+    executor = ThreadPoolExecutor(max_workers=args.num_workers)
+    try:
+        with open(args.out_file, "ab") as out_f:
+            futures = [
+                executor.submit(fetch_full_text, session, rate_limiter, sample["corpus_id"]) for sample in papers
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures), **TQDM_KWARGS):
+                corpus_id, data = future.result()
+
+                if "error" in data:
+                    # print(f"Skipping {corpus_id} due to error:")
+                    # print(data)
+                    if isinstance(data["error"], str) and data["error"].startswith("CorpusId is not showable"):
+                        unshowable_corpus_ids.append(corpus_id)
+                    else:
+                        other_error_corpus_ids.append(corpus_id)
+                    continue
+
+                if "metadata" not in data:
+                    print(data.keys())
+                    data["metadata"] = {"corpusId": corpus_id}
+                else:
+                    data["metadata"]["corpusId"] = corpus_id
+
+                # write each paper as soon as it arrives so an interrupted run can be resumed
+                out_f.write(dumps_line(data))
+                num_saved += 1
+                if num_saved % FLUSH_EVERY == 0:
+                    out_f.flush()
+    finally:
+        # if the run is interrupted (e.g. with ctrl-c), drop the queued downloads rather than waiting on them,
+        # and still record the errors seen so far
+        executor.shutdown(cancel_futures=True)
+        with open(os.path.splitext(args.out_file)[0] + "_errors.jsonl", "ab") as errors_f:
+            save_jsons(
+                [{"unshowable_ids": unshowable_corpus_ids, "other_error_ids": other_error_corpus_ids}], errors_f
+            )
     print("done")
 
 
@@ -1,8 +1,10 @@
 from argparse import ArgumentParser
 from collections import defaultdict
-import copy
+from dataclasses import dataclass
 import functools
 import gzip
+import hashlib
+import io
 import json
 import multiprocessing
 import os
@@ -11,192 +13,302 @@ import sys
 from typing import List
 import warnings
 
-from bs4 import BeautifulSoup
+from lxml import etree
 import pandas as pd
 from tqdm import tqdm
 
 from summarize_dataset import get_aspect_type
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+except ImportError:
+    _loads = json.loads
+
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+try:
+    # isal's igzip is a drop-in (and much faster) replacement for the gzip module
+    from isal import igzip as gzip_lib
+except ImportError:
+    gzip_lib = gzip
+
+
+# `recover` keeps going past malformed markup (like the bs4 "lxml-xml" parser we used to use did)
+XML_PARSER = etree.XMLParser(recover=True, huge_tree=True)
+
+# compiled once and reused for every table
+FIND_TABLES = etree.XPath("descendant-or-self::table")
+FIND_TRS = etree.XPath(".//tr")
+FIND_TDS = etree.XPath(".//td")
+FIND_CITS = etree.XPath(".//cit")
+FIND_PS = etree.XPath(".//p")
+FIND_TDS_AND_PS = etree.XPath(".//td|.//p")
+
+# read compressed inputs and write outputs in 1 MiB chunks rather than the default 8 KiB
+READ_BUFFER_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def open_jsonl(path):
+    """Opens a .jsonl or .jsonl.gz file for reading. Lines are bytes, which `_loads` parses without decoding."""
+    if os.path.splitext(path)[1] == ".gz":
+        return io.BufferedReader(gzip_lib.open(path, "rb"), buffer_size=READ_BUFFER_SIZE)
+    return open(path, "rb")
+
+
+def iter_jsonl(path):
+    """Yields the parsed lines of a .jsonl or .jsonl.gz file one at a time, so the file is never held in memory."""
+    with open_jsonl(path) as f:
+        for line in f:
+            yield _loads(line)
+
+
+def write_jsonl(path, samples):
+    """Writes `samples` (any iterable) to `path` as json lines."""
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines(_dumps_line(sample) for sample in samples)
+
+
+def iter_and_write_jsonl(path, samples):
+    """
+    Yields each of `samples`, writing it to `path` as a json line first. The file is complete once the
+    generator is exhausted.
+    """
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for sample in samples:
+            f.write(_dumps_line(sample))
+            yield sample
+
 
 def soupify(table_json):
-    soup = BeautifulSoup(table_json, "lxml-xml")
-    for row in soup.find_all("row"):
-        row.name = "tr"
-    for cell in soup.find_all("cell"):
-        cell.name = "td"
-    for tex_math in soup.find_all("texmath"):
-        # remove the "texmath"
-        tex_math.extract()
-    return soup
+    """Parses the table xml into an lxml element, with rows and cells renamed to "tr" and "td"."""
+    return normalize_table(etree.fromstring(table_json.encode(), XML_PARSER))
+
 
+def normalize_table(table_soup):
+    if table_soup is None:
+        # nothing could be recovered from the xml
+        return etree.Element("table")
+    for el in list(table_soup.iter("row", "cell")):
+        el.tag = "tr" if el.tag == "row" else "td"
+    # remove the "texmath" (but keep any text that follows it)
+    etree.strip_elements(table_soup, "texmath", with_tail=False)
+    return table_soup
 
-# Define our filters
-def has_x(table_soup):
-    return "✗" in " ".join(table_soup.strings)
 
+def soup_to_str(table_soup):
+    return etree.tostring(table_soup, encoding="unicode")
 
-def not_too_long_15e3(table_soup):
-    return len(str(table_soup)) < 15e3
 
+def get_text(el):
+    return "".join(el.itertext())
 
-def not_too_long_5e3(table_soup):
-    return len(str(table_soup)) < 5e3
 
+def get_table_key(table_soup):
+    """
+    A small digest of the table's xml, used to spot tables that were already seen. lxml elements hash by identity,
+    and a digest (unlike the xml itself) doesn't keep the tables' content around. Unlike `hash`, it's also the same
+    in every process.
+    """
+    return hashlib.blake2b(etree.tostring(table_soup, with_tail=False), digest_size=16).digest()
+
+
+@dataclass
+class TableView:
+    """
+    Wraps a parsed table so that the node lists and text the filters need are each
+    collected once per table (on first use) rather than once per filter.
+    """
+
+    soup: etree._Element
+    raw_xml_len: int  # length of the xml string the table was parsed from
 
-def not_too_long_or_short(table_soup):
-    # return len(str(table_soup)) < 5e3
-    return 398 < len(str(table_soup)) < 15e3
+    @functools.cached_property
+    def trs(self):
+        return FIND_TRS(self.soup)
 
+    @functools.cached_property
+    def tds(self):
+        return FIND_TDS(self.soup)
 
-def has_rows(table_soup):
-    return table_soup.find("tr")
+    @functools.cached_property
+    def cits(self):
+        return FIND_CITS(self.soup)
 
+    @functools.cached_property
+    def ps(self):
+        return FIND_PS(self.soup)
 
-def has_max_2_sub_tables(table_soup):
-    return len(table_soup.find_all("table")) <= 2
+    @functools.cached_property
+    def sub_tables(self):
+        return FIND_TABLES(self.soup)
 
+    @functools.cached_property
+    def row_cells(self):
+        # the td nodes of each row in `trs`
+        return [FIND_TDS(row) for row in self.trs]
 
-def has_at_least_2_cols(table_soup):
+    @functools.cached_property
+    def serialized(self):
+        return soup_to_str(self.soup)
+
+    @functools.cached_property
+    def serialized_len(self):
+        return len(self.serialized)
+
+    @functools.cached_property
+    def strings_joined(self):
+        return " ".join(self.soup.itertext())
+
+    @functools.cached_property
+    def cell_text(self):
+        # the text of all of the td and p nodes. They're joined with spaces so matches can't span two nodes
+        return " ".join(get_text(el) for el in FIND_TDS_AND_PS(self.soup))
+
+
+# Define our filters. Each takes a `TableView`
+def has_x(table_view):
+    return "✗" in table_view.strings_joined
+
+
+# the length filters use the length of the raw xml, so the parsed table doesn't need to be serialized
+def not_too_long_15e3(table_view):
+    return table_view.raw_xml_len < 15e3
+
+
+def not_too_long_5e3(table_view):
+    return table_view.raw_xml_len < 5e3
+
+
+def not_too_long_or_short(table_view):
+    # return table_view.raw_xml_len < 5e3
+    return 398 < table_view.raw_xml_len < 15e3
+
+
+def has_rows(table_view):
+    return len(table_view.trs) > 0
+
+
+def has_max_2_sub_tables(table_view):
+    return len(table_view.sub_tables) <= 2
+
+
+def has_at_least_2_cols(table_view):
     # td is number of cells, so use combo of # cells and # of rows to get columns
-    return len(table_soup.find_all("td")) >= 4 and len(table_soup.find_all("tr")) >= 2
+    return len(table_view.tds) >= 4 and len(table_view.trs) >= 2
 
 
-def has_at_least_2_rows(table_soup):
-    return len(table_soup.find_all("tr")) >= 2
+def has_at_least_2_rows(table_view):
+    return len(table_view.trs) >= 2
 
 
-def has_cites(table_soup):
-    soup_text = " ".join(table_soup.strings)
-    return len(table_soup.find_all("cit")) > 0 or ("et al" in soup_text)
+def has_cites(table_view):
+    return len(table_view.cits) > 0 or ("et al" in table_view.strings_joined)
 
 
-def has_at_least_2_cites(table_soup):
-    return len(table_soup.find_all("cit")) >= 2
+def has_at_least_2_cites(table_view):
+    return len(table_view.cits) >= 2
 
 
-def has_cites_in_first_row_or_col(table_soup):
+def has_cites_in_first_row_or_col(table_view):
     """
     Checks for citations in the first row or column
     (this is quite restrictive)
     """
     min_num_cites = 2
-    trs = table_soup.find_all("tr")
+    trs = table_view.trs
+    row_cells = table_view.row_cells
 
     # check the first, non-empty row
     i = 0
     while i < len(trs):
         first_row = trs[i]
-        cells = first_row.find_all("td")
+        cells = row_cells[i]
 
         # skip any all-empty rows
-        if all([not cell.text.strip() for cell in cells]):
+        if all(not get_text(cell).strip() for cell in cells):
             i += 1
             continue
 
-        if len(first_row.find_all("cit")) >= min_num_cites:
+        if len(FIND_CITS(first_row)) >= min_num_cites:
             return True
         else:
             break
 
     # check the first column (usually not empty)
-    # first_col_citations = [row.find("cit") for row in trs if row.find("cit") is not None]
-    first_col_citations = [row.find_all("td")[0].find("cit") for row in trs]
+    # first_col_citations = [row.find(".//cit") for row in trs if row.find(".//cit") is not None]
+    first_col_citations = [cells[0].find(".//cit") for cells in row_cells]
     return len([cell for cell in first_col_citations if cell is not None]) >= min_num_cites
 
 
-def has_cites_in_rows_or_cols(table_soup):
+def has_cites_in_rows_or_cols(table_view):
     """
     Checks *any* row or col to see if it has >2 cites
     """
     min_num_cites = 2
-    trs = table_soup.find_all("tr")
+    row_cells = table_view.row_cells
 
-    valid_table = False
     max_num_cells = 0
-    for row in trs:
-        cells = row.find_all("td")
+    for row, cells in zip(table_view.trs, row_cells):
         # skip any all-empty rows
-        if all([not cell.text.strip() for cell in cells]):
+        if all(not get_text(cell).strip() for cell in cells):
             continue
 
         # track max number of cells per row to help with processing column
         max_num_cells = max(max_num_cells, len(cells))
 
-        if len(row.find_all("cit")) >= min_num_cites:
-            valid_table = True
-            break
+        if len(FIND_CITS(row)) >= min_num_cites:
+            return True
 
     # check columns. Assumes that we don't have weird multicolumn stuff going on,
     # so it's a bit coarse. E.g. row[0][3] is the same column as row[3][3]
-    if not valid_table and max_num_cells > 0:
-        for col_i in range(max_num_cells):
-            col_citations = []
-            for row in trs:
-                try:
-                    col_citations.append(row.find_all("td")[col_i].find("cit"))
-                except IndexError:
-                    continue
-            # print(col_citations)
-            if len([cell for cell in col_citations if cell is not None]) >= min_num_cites:
-                valid_table = True
-                break
-    return valid_table
+    for col_i in range(max_num_cells):
+        num_col_cites = sum(
+            1 for cells in row_cells if col_i < len(cells) and cells[col_i].find(".//cit") is not None
+        )
+        if num_col_cites >= min_num_cites:
+            return True
+    return False
 
 
-def has_max_one_cite_per_cell(table_soup):
+def has_max_one_cite_per_cell(table_view):
     """
     We don't want any tables with more than one citation per cell.
     Returns True if any cell has a maximum of one citation
     """
     max_cites_per_cell = 1
-    trs = table_soup.find_all("tr")
 
-    valid_table = False
-    for row in trs:
-        for cell in row.find_all("td"):
-            if len(cell.find_all("cit")) > max_cites_per_cell:
+    for cells in table_view.row_cells:
+        for cell in cells:
+            if len(FIND_CITS(cell)) > max_cites_per_cell:
                 return False
     return True
 
 
-# FLOAT_REGEX = re.compile("\d\.\d")
-FLOAT_REGEX = re.compile("\.\d")
-
+# FLOAT_REGEX = re.compile(r"\d\.\d")
+# only ascii digits count, which also lets the regex engine skip the unicode digit lookups
+FLOAT_REGEX = re.compile(r"\.\d", re.ASCII)
 
-def has_no_floats(table_soup):
-    for cell in table_soup.find_all("td"):
-        cell_text = cell.get_text()
-        if cell_text and FLOAT_REGEX.search(cell_text) is not None:
-            return False
 
+def has_no_floats(table_view):
     # some tables have floats in paragraphs, which is confusing but
-    # not always recovered for some reason
-    for cell in table_soup.find_all("p"):
-        cell_text = cell.get_text()
-        if cell_text and FLOAT_REGEX.search(cell_text) is not None:
-            return False
-    # for s in table_soup.strings:
-    #     s = s.strip()
-    #     if s and FLOAT_REGEX.search(s) is not None:
-    #         return False
-    return True
-
+    # not always recovered for some reason, so those are checked too
+    return FLOAT_REGEX.search(table_view.cell_text) is None
 
-def has_table_cells(table_soup):
-    return table_soup.find("td") is not None
 
+def has_table_cells(table_view):
+    return len(table_view.tds) > 0
 
-def has_no_figures(table_soup):
-    for cell in table_soup.find_all("td"):
-        cell_text = cell.get_text()
-        if cell_text and r"{{figure" in cell_text:
-            return False
 
-    for cell in table_soup.find_all("p"):
-        cell_text = cell.get_text()
-        if cell_text and r"{{figure" in cell_text:
-            return False
-    return True
+def has_no_figures(table_view):
+    return r"{{figure" not in table_view.cell_text
 
 
 DEFAULT_TABLE_LABELS = [
@@ -214,16 +326,17 @@ DEFAULT_TABLE_LABELS = [
     has_max_one_cite_per_cell,
 ]
 
+# ordered so that the cheap checks that reject the most tables run first
 DEFAULT_TABLE_FILTERS = [
-    has_cites_in_rows_or_cols,
-    has_at_least_2_cites,
-    # has_no_floats,
+    has_table_cells,
     not_too_long_or_short,
+    has_at_least_2_rows,
     has_at_least_2_cols,
     has_max_2_sub_tables,
-    has_at_least_2_rows,
+    has_at_least_2_cites,
+    # has_no_floats,
     # has_no_figures,
-    has_table_cells,
+    has_cites_in_rows_or_cols,
 ]
 
 
@@ -231,16 +344,68 @@ DEFAULT_TABLE_FILTERS = [
 COLORS = r"((alice)?blue|black|(mid)?gr[ae]y|red|(dark)?green|tablewhite|tableblue)"
 COLORS_RE = rf"{COLORS}(\!\d\d?|(?=[✗✓]))"
 
+# the regexes used per-cell are compiled once here
+CITE_RE = re.compile(r"\{\{cite:[a-f\d]{7}\}\}")
+CITE_GROUP_RE = re.compile(r"\{\{cite:([a-f\d]{7})\}\}")
+CITE_CAPTURE_RE = re.compile(rf"({CITE_RE.pattern})")  # the whole citation, as a group for `str.extract`
+MULTIROW_RE = re.compile(r"(\d)\*(.+)")
+HLINE_RE = re.compile(r"\(r\)\d-\d")
+COLORS_END_RE = re.compile(COLORS_RE)
+COLORS_START_RE = re.compile(rf"^{COLORS}")
+POSITION_RE = re.compile(r"\[[cl]\]")
+FONT_SIZE_RE = re.compile(r"^\d\d+em")
+NA_RE = re.compile(r"(N/A|none)")
+# and the ones used per-column in `get_high_quality_tables`
+CITE_AND_COMMA_RE = re.compile(r"(and|[,])")
+NUMBER_COL_RE = re.compile(r"\d+", re.ASCII)  # used with `fullmatch`
+ANY_CITE_RE = re.compile(r"\{\{cite:.{7}\}\}")
+
 
 def is_na(text):
     return text.lower() == "n/a" or not text.strip() or text == "\u2216"
 
 
-def extract_valid_tables(path, table_filters, label_tables=False):
+# the tags counted by `stream_prefilter`, and the names they have after `soupify`
+PREFILTER_TAGS = {"table": "table", "row": "tr", "tr": "tr", "cell": "td", "td": "td", "cit": "cit"}
+
+
+def stream_prefilter(table_json, table_filters):
+    """
+    Like `soupify`, but parses the xml incrementally while counting tables, rows, cells and citations
+    (outside of "texmath", which `soupify` removes). Returns None as soon as it's clear that one of the
+    count-based filters in `table_filters` will reject the table, so that the expensive filters only
+    run on the tables that survive.
+    """
+    max_tables = 2 if has_max_2_sub_tables in table_filters else float("inf")
+    counts = dict.fromkeys(PREFILTER_TAGS.values(), 0)
+    texmath_depth = 0
+    events = etree.iterparse(io.BytesIO(table_json.encode()), events=("start", "end"), recover=True, huge_tree=True)
+    for event, el in events:
+        if el.tag == "texmath":
+            texmath_depth += 1 if event == "start" else -1
+        elif event == "start" and texmath_depth == 0 and el.tag in PREFILTER_TAGS:
+            counts[PREFILTER_TAGS[el.tag]] += 1
+            if counts["table"] > max_tables:
+                return None
+
+    if has_table_cells in table_filters and counts["td"] == 0:
+        return None
+    if has_at_least_2_rows in table_filters and counts["tr"] < 2:
+        return None
+    if has_at_least_2_cols in table_filters and (counts["td"] < 4 or counts["tr"] < 2):
+        return None
+    if has_at_least_2_cites in table_filters and counts["cit"] < 2:
+        return None
+    return normalize_table(events.root)
+
+
+def extract_valid_tables(path, table_filters, label_tables=False, num_processes=1):
     """
     If `label_tables` is True, return all of the tables, but list
     what labels are true/false for each of them.
 
+    If `num_processes` > 1, the papers are parsed and filtered in a pool of that many processes.
+
 
     path by default is "arxiv_dump/out_xml/2310.00000-07773.jsonl"
 
@@ -273,60 +438,89 @@ def extract_valid_tables(path, table_filters, label_tables=False):
     Finally, run
     python scripts/data_processing/download_full_texts.py data/arxiv_tables/2308_papers.jsonl
     """
-    valid_tables = []
-    if os.path.splitext(path)[1] == ".gz":
-        f = gzip.open(path, "r")
-    else:
-        f = open(path)
+    f = open_jsonl(path)
+    # when filtering, tables that are too long or short are dropped before they're parsed
+    prefilter_length = not label_tables and not_too_long_or_short in table_filters
+    process_paper = functools.partial(
+        filter_paper_tables, table_filters=table_filters, label_tables=label_tables, prefilter_length=prefilter_length
+    )
     with f:
-        added_tables = set()
-        for line in tqdm(f):
-            paper = json.loads(line)
-            filtered_tables = {}
-            for key, table in paper["tables"].items():
-                if table["table"]:
-                    table_soup = soupify(table["table"])
-
-                    if label_tables:
-                        # label the tables with the filters they pass
-                        labels = {}
-                        for flter in table_filters:
-                            labels[flter.__name__] = flter(table_soup)
-                        labels["len"] = len(str(table_soup))
-                    else:
-                        # Filter tables
-                        exit_early = False
-                        for flter in table_filters:
-                            if not flter(table_soup):
-                                # exit early as soon as a filter is wrong
-                                exit_early = True
-                                break
-
-                        if exit_early:
-                            continue
-
-                    # Keep the outermost table always. But prevent adding smaller tables
-                    # Remove duplicates (as long as the larger table comes first, the smaller ones
-                    # won't make it in). Usually the larger seems to come first.
-                    if table_soup.find("table") in added_tables:
-                        continue
-                    else:
-                        for sub_table in table_soup.find_all("table"):
-                            added_tables.add(sub_table)
-
-                    filtered_tables[key] = table
-                    filtered_tables[key]["soup"] = table_soup
-                    if label_tables:
-                        filtered_tables[key]["labels"] = labels
-
-            if filtered_tables:
-                new_paper = {k: v for k, v in paper.items() if k != "tables"}
-                new_paper["tables"] = filtered_tables
-                valid_tables.append(new_paper)
-
-            # For debugging
-            # if len(valid_tables) > 10:
-            #     break
+        if num_processes > 1:
+            # `imap` (rather than `imap_unordered`) keeps the papers in order, which the de-duplication relies on
+            with multiprocessing.Pool(num_processes) as pool:
+                valid_tables = drop_duplicate_tables(pool.imap(process_paper, f, chunksize=16))
+        else:
+            valid_tables = drop_duplicate_tables(map(process_paper, f))
+    return valid_tables
+
+
+def filter_paper_tables(line, table_filters, label_tables, prefilter_length):
+    """
+    Parses one paper (a line of the input) and runs the filters over its tables. Returns the paper without its
+    tables (or None if none of them pass) and a list of (key, table, sub_table_keys) for the tables that do.
+
+    This runs in the worker processes, so the tables are returned serialized (as "table_html") rather than
+    as lxml elements, which can't be pickled.
+    """
+    paper = _loads(line)
+    kept_tables = []
+    for key, table in paper["tables"].items():
+        if not table["table"]:
+            continue
+        if prefilter_length and not (398 < len(table["table"]) < 15e3):
+            continue
+        if label_tables:
+            table_soup = soupify(table["table"])
+        else:
+            table_soup = stream_prefilter(table["table"], table_filters)
+            if table_soup is None:
+                continue
+        table_view = TableView(table_soup, len(table["table"]))
+
+        if label_tables:
+            # label the tables with the filters they pass
+            labels = {}
+            for flter in table_filters:
+                labels[flter.__name__] = flter(table_view)
+            labels["len"] = table_view.serialized_len
+            table["labels"] = labels
+        else:
+            # Filter tables, exiting early as soon as a filter is wrong
+            if not all(flter(table_view) for flter in table_filters):
+                continue
+
+        table["table_html"] = table_view.serialized
+        sub_table_keys = [get_table_key(sub_table) for sub_table in table_view.sub_tables]
+        kept_tables.append((key, table, sub_table_keys))
+
+    if not kept_tables:
+        return None, kept_tables
+    return {k: v for k, v in paper.items() if k != "tables"}, kept_tables
+
+
+def drop_duplicate_tables(filtered_papers):
+    """Collects the output of `filter_paper_tables` into papers, leaving out tables that were already seen."""
+    valid_tables = []
+    added_tables = set()
+    for new_paper, kept_tables in tqdm(filtered_papers):
+        filtered_tables = {}
+        for key, table, sub_table_keys in kept_tables:
+            # Keep the outermost table always. But prevent adding smaller tables
+            # Remove duplicates (as long as the larger table comes first, the smaller ones
+            # won't make it in). Usually the larger seems to come first.
+            if sub_table_keys and sub_table_keys[0] in added_tables:
+                continue
+            else:
+                added_tables.update(sub_table_keys)
+            filtered_tables[key] = table
+
+        if filtered_tables:
+            new_paper["tables"] = filtered_tables
+            valid_tables.append(new_paper)
+
+        # For debugging
+        # if len(valid_tables) > 10:
+        #     break
 
     return valid_tables
 
@@ -337,41 +531,36 @@ def split_references_column(table_df):
     # must be unique
     # determine which column has the most references
 
-    # use iloc in case the name of the column is repeated
-    column_with_cites = table_df.iloc[:, 0]  # by default it's the first one
-    max_num_cites = -1
-    for col_i, _ in enumerate(table_df.columns):
-        num_cites = 0
-        for cell_val in table_df.iloc[:, col_i]:
-            matches = re.search("{{cite:[a-f\d]{7}}}", cell_val)
-            if matches is not None:
-                num_cites += 1
-        if num_cites > max_num_cites:
-            max_num_cites = num_cites
-            column_with_cites = table_df.iloc[:, col_i]
+    # count the cells with citations in each column with one pass over the raw (numpy) cell values, then use iloc
+    # in case the name of the column is repeated. Ties go to the first column
+    cell_grid = table_df.to_numpy(dtype=object)
+    cell_has_cite = pd.Series(cell_grid.ravel(), dtype=object).str.contains(CITE_RE).to_numpy(dtype=bool)
+    cite_counts = cell_has_cite.reshape(cell_grid.shape).sum(axis=0)
+    column_with_cites = table_df.iloc[:, int(cite_counts.argmax())]
 
     if isinstance(column_with_cites, pd.DataFrame):
         column_with_cites = column_with_cites.agg("".join, axis=1)
-    references_col = []
 
     new_column_without_cites_name = column_with_cites.name
 
-    new_column_without_cites = []
-    no_cite_count = 0
-    for cell_val in column_with_cites:
-        matches = re.search("{{cite:[a-f\d]{7}}}", cell_val)
-        if matches is None:
-            references_col.append(f"no_cite-{no_cite_count}")
-            new_column_without_cites.append(cell_val)
-            no_cite_count += 1
-        else:
-            references_col.append(matches[0])
-            new_cell_val = cell_val.replace(matches[0], "")
-            if not new_cell_val:
-                new_cell_val = "-"
-            new_column_without_cites.append(new_cell_val.strip())
-
-    if any([val != "-" for val in new_column_without_cites]):
+    # the first citation in each cell (NaN where there isn't one)
+    cell_vals = column_with_cites.to_numpy(dtype=object)
+    cites = column_with_cites.str.extract(CITE_CAPTURE_RE, expand=False).to_numpy(dtype=object)
+    no_cite = pd.isna(cites)
+    has_cite = ~no_cite
+
+    # cells without citations get a placeholder reference and keep their value. For the others, the
+    # citation moves to the references column
+    references_col = cites.copy()
+    references_col[no_cite] = [f"no_cite-{i}" for i in range(no_cite.sum())]
+    new_column_without_cites = cell_vals.copy()
+    new_column_without_cites[has_cite] = [
+        (cell_val.replace(cite, "") or "-").strip() for cell_val, cite in zip(cell_vals[has_cite], cites[has_cite])
+    ]
+    references_col = references_col.tolist()
+    new_column_without_cites = new_column_without_cites.tolist()
+
+    if any(val != "-" for val in new_column_without_cites):
         if new_column_without_cites_name == "References":
             # This only gets triggered in weird cases where one of the columns is "References" but
             # we don't successfully parse out all of the citations (eg if there is more than one cite
@@ -398,6 +587,42 @@ def split_references_column(table_df):
     return table_df, new_column_without_cites_name
 
 
+def process_cells(cells):
+    """The heuristics defined here are a start for normalizing cell content. In reality they
+    are not sufficient. There is a lot of manual post-editing that must be conducted on the
+    tables.
+
+    `cells` is a Series of cell values, which are normalized with vectorized string operations."""
+    # replace non-breaking space with normal space (tuples, from multi-level headers, become strings)
+    cells = cells.astype(str).str.replace("\u00a0", " ", regex=False).str.strip()
+
+    # normalize apostrophes
+    cells = cells.str.replace("’", "'", regex=False)
+    # binary no
+    cells = cells.mask(cells == "X", "\u2717")
+    cells = cells.mask(cells == "tablered", "no")
+    # cells = cells.str.replace(f"{COLORS}\u2717", "\u2717", regex=True)
+    # binary yes - standardize
+    cells = cells.str.replace("\u2714", "\u2713", regex=False)
+    cells = cells.mask(cells == "tablegreen", "yes")
+
+    # remove color annotations from end
+    cells = cells.str.replace(COLORS_END_RE, "", regex=True)
+    # and from beginning - this is potentially dangerous...
+    cells = cells.str.replace(COLORS_START_RE, "", regex=True)
+
+    # remove latex positioning markers that can come in:
+    cells = cells.str.replace(POSITION_RE, "", regex=True)
+
+    # remove font size info
+    cells = cells.str.replace(FONT_SIZE_RE, "", regex=True)
+
+    # empty cells should be "-" instead
+    cells = cells.str.replace(NA_RE, "-", regex=True)
+    cells = cells.str.strip()
+    return cells.mask(cells == "", "-")
+
+
 def postprocess_table_df(table_df):
     """
     Converts a list, where each element is row, into a dictionary representing
@@ -417,50 +642,12 @@ def postprocess_table_df(table_df):
             table_df = table_df.transpose().reset_index()
             # breakpoint()
 
-    def process_cell(cell):
-        """The heuristics defined here are a start for normalizing cell content. In reality they
-        are not sufficient. There is a lot of manual post-editing that must be conducted on the
-        tables."""
-        # replace non-breaking space with normal space
-        if isinstance(cell, tuple):
-            cell = str(cell)
-        cell = cell.replace("\u00a0", " ")
-        cell = cell.strip()
-
-        # normalize apostrophes
-        cell = re.sub("[’]", "'", cell)
-        # binary no
-        if cell == "X":
-            cell = "\u2717"
-
-        if cell == "tablered":
-            cell = "no"
-        # cell = re.sub(f"{COLORS}\u2717", "\u2717", cell)
-        # binary yes - standardize
-        cell = re.sub("\u2714", "\u2713", cell)
-        if cell == "tablegreen":
-            cell = "yes"
-
-        # remove color annotations from end
-        cell = re.sub(f"{COLORS_RE}", "", cell)
-        # and from beginning - this is potentially dangerous...
-        cell = re.sub(rf"^{COLORS}", "", cell)
-
-        # remove latex positioning markers that can come in:
-        cell = re.sub(r"\[[cl]\]", "", cell)
-
-        # remove font size info
-        cell = re.sub(r"^\d\d+em", "", cell)
-
-        # empty cells should be "-" instead
-        cell = re.sub(r"(N/A|none)", "-", cell)
-        cell = cell.strip()
-        if cell == "":
-            cell = "-"
-        return cell
-
-    table_df = table_df.map(process_cell)
-    table_df.columns = table_df.columns.map(process_cell)
+    # normalize all of the cells in one go, keeping the shape (and possibly repeated column names) of the table
+    cells = process_cells(pd.Series(table_df.to_numpy(dtype=object).ravel(), dtype=object))
+    table_df = pd.DataFrame(
+        cells.to_numpy(dtype=object).reshape(table_df.shape), index=table_df.index, columns=table_df.columns
+    )
+    table_df.columns = process_cells(pd.Series(list(table_df.columns), dtype=object)).tolist()
     # print(table_df.columns)
 
     # if the cells have citations and other information, put the citations into a new cell
@@ -469,31 +656,35 @@ def postprocess_table_df(table_df):
     return table_df, old_col_with_cites_name
 
 
-def merge_rows(table, row_i, row_j):
-    new_row = []
-    for val_i, val_j in zip(table[row_i], table[row_j]):
-        if val_i == val_j or not val_j.strip():
-            new_row.append(val_i)
-        elif not val_i.strip():
-            new_row.append(val_j)
-        else:
-            new_row.append("-".join([val_i, val_j]))
-    table[row_i] = new_row
-    del table[row_j]
-    return table
+def merge_header_rows(table, last_header_row):
+    """
+    Collapses rows 0 through `last_header_row` of `table` into a single header row. The rows are folded in
+    one at a time, and the consumed rows are sliced off once at the end (rather than deleted one by one).
+    """
+    new_row = table[0]
+    for row in table[1 : last_header_row + 1]:
+        new_row = [
+            val_i if val_i == val_j or not val_j.strip() else val_j if not val_i.strip() else f"{val_i}-{val_j}"
+            for val_i, val_j in zip(new_row, row)
+        ]
+    return [new_row] + table[last_header_row + 1 :]
 
 
 def soup_to_json(table_soup, verbose=False):
-    # first, determine the number of columns as the max number of cells in a row
-    num_cols = max(
-        [len(row.find_all("td")) for row in table_soup.find_all("tr")]
-        + [
-            sum([int(cell.attrs.get("cols", "1")) for cell in row.find_all("td")])
-            for row in table_soup.find_all("tr")
-        ]
-    )
+    # walk the tree once, collecting each row's cells, their text, how many columns they span, and the
+    # number of cells with citations
+    rows = []
+    for row in FIND_TRS(table_soup):
+        cells = FIND_TDS(row)
+        cell_texts = [get_text(cell) for cell in cells]
+        spans = [int(cell.get("cols", "1")) for cell in cells]
+        num_cites = sum(1 for cell in cells if cell.find(".//cit") is not None)
+        rows.append((cell_texts, spans, num_cites))
+
+    # first, determine the number of columns as the max number of cells (or spanned columns) in a row
+    num_cols = max(max(len(spans), sum(spans)) for _, spans, _ in rows)
     # next, determine the number of rows:
-    num_rows = len(table_soup.find_all("tr"))
+    num_rows = len(rows)
 
     if verbose:
         print(num_rows, num_cols)
@@ -512,12 +703,9 @@ def soup_to_json(table_soup, verbose=False):
     # Next, fill in table[row_i][col_i]
     header_rows = []
     seen_cites = False
-    for row_i, row in enumerate(table_soup.find_all("tr")):
-        cells = row.find_all("td")
-
+    for row_i, (cell_texts, spans, num_cites) in enumerate(rows):
         col_i = 0
         # if a row does not contain any citations and we only have one row in the table, then say it's part of the header row
-        num_cites = len([cell for cell in cells if cell.find("cit") is not None])
         if num_cites > 0:
             seen_cites = True
         if num_cites == 0 and row_i <= 1 and not seen_cites:
@@ -527,27 +715,26 @@ def soup_to_json(table_soup, verbose=False):
             header_rows.append(row_i)
 
         # determine if the current row is a header row
-        if len(cells) < num_cols and not seen_cites:
+        if len(cell_texts) < num_cols and not seen_cites:
             if verbose:
                 print(f"not enough cols in row: {row_i}, adding as header")
             header_rows.append(row_i)
-        elif len(cells) < num_cols or any(["{{figure:" in cell.text for cell in cells]):
+        elif len(cell_texts) < num_cols or any("{{figure:" in text for text in cell_texts):
             # for cell in cells:
             table["incomplete_rows"].append(
                 {
                     "row_idx": row_i,
-                    "cells": [cell.text for cell in cells],
+                    "cells": cell_texts,
                 }
             )
             continue
 
-        for cell in cells:
+        for text, num_spanning_cols in zip(cell_texts, spans):
             # acount for multi-column cells
-            num_spanning_cols = int(cell.attrs.get("cols", "1"))
             for col_offset in range(num_spanning_cols):
-                cell_text = cell.text
+                cell_text = text
                 # account for multi-row cells
-                multirow_cell = re.search(r"(\d)\*(.+)", cell_text)
+                multirow_cell = MULTIROW_RE.search(cell_text)
                 if multirow_cell:
                     count = int(multirow_cell[1])
                     cell_text = multirow_cell[2]
@@ -568,10 +755,10 @@ def soup_to_json(table_soup, verbose=False):
                             }
 
                 # if a cell contains a horizontal line, don't add it but mark it as a header row
-                if re.search("\(r\)\d-\d", cell_text):  #  and not seen_cites:
+                if HLINE_RE.search(cell_text):  #  and not seen_cites:
                     # print("horizontal line added as header_row")
                     # header_rows.append(row_i + 1)
-                    cell_text = re.sub("\(r\)\d-\d", "", cell_text)
+                    cell_text = HLINE_RE.sub("", cell_text)
                     # continue
 
                 if (
@@ -590,8 +777,7 @@ def soup_to_json(table_soup, verbose=False):
     if verbose:
         print(header_rows)
     if header_rows:
-        for _ in range(max(header_rows)):
-            table["table"] = merge_rows(table["table"], 0, 1)
+        table["table"] = merge_header_rows(table["table"], max(header_rows))
 
     # remove any empty rows
     table_filtered = []
@@ -605,7 +791,7 @@ def soup_to_json(table_soup, verbose=False):
             print(row)
 
     # next, assume the first row has the column headers and the first col has the row headers
-    if not any(["".join(row) for row in table["table"]]):
+    if not any("".join(row) for row in table["table"]):
         table_dict = {}
     else:
         table_df = pd.DataFrame(table["table"][1:], columns=table["table"][0])
@@ -617,7 +803,7 @@ def soup_to_json(table_soup, verbose=False):
     return table
 
 
-def get_table_row_bib_map(table_json, bib_hashes, paper_id) -> List:
+def get_table_row_bib_map(table_json, cite_id_map, paper_id) -> List:
     """
     Uses the heuristic that if a table contains a row that doesn't have a citation,
     then that row represents the containing paper, as long as the cell doesn't contain
@@ -627,16 +813,18 @@ def get_table_row_bib_map(table_json, bib_hashes, paper_id) -> List:
     a row number, the corpus id, bib_hash or arxiv id, and whether the row is the paper
     with the table ("ours") or an external reference ("ref").
 
+    `cite_id_map` maps the 7 character cite ids in the table to the full bib hashes.
+
     TODO: could also be "above". there could also be more than one "ours" row.
     """
 
     table_row_bib_map = []
-    cite_id_map = {bib_ref[:7]: bib_ref for bib_ref in bib_hashes if bib_ref is not None}
-    table_df = pd.DataFrame(table_json)
     ours_row = None
-    for i, cell_val in enumerate(table_df[table_df.columns[0]]):
+    # only the first column (the references) is needed, so read it straight from the dict
+    first_col_vals = next(iter(table_json.values()))
+    for i, cell_val in enumerate(first_col_vals):
         # extract the citation
-        matches = re.search("{{cite:([a-f\d]{7})}}", cell_val)
+        matches = CITE_GROUP_RE.search(cell_val)
         if matches is None:
             # we could be in an "ours" row
             if "standard" in cell_val.lower():
@@ -671,29 +859,36 @@ def get_table_row_bib_map(table_json, bib_hashes, paper_id) -> List:
 def create_dataset(labeled_tables, filters):
     """
     Flattens the tables_by_paper into a list of tables with associated information to create a dataset."""
-    dataset = []
-    if labeled_tables and labeled_tables[0].get("labels") is None:
-        print("Unable to find labels on the tables. All are being converted to json.")
+    return list(iter_dataset(labeled_tables, filters))
+
+
+def write_dataset_jsonl(path, labeled_tables, filters):
+    """Like `create_dataset`, but writes each table to `path` as it's created rather than building a list."""
+    write_jsonl(path, iter_dataset(labeled_tables, filters))
+
+
+def iter_dataset(labeled_tables, filters):
+    """Yields the tables of `create_dataset` one at a time. `labeled_tables` can be a list or any iterable."""
     missing_bib_hashes = []
     skipped_table_hashes = []
-    for table_i, table in tqdm(enumerate(labeled_tables), total=len(labeled_tables)):
-        should_skip_table = False
-
+    # the label keys to check, looked up once rather than per table
+    filter_names = tuple(filter_fn.__name__ for filter_fn in filters)
+    total = len(labeled_tables) if isinstance(labeled_tables, list) else None
+    for table_i, table in tqdm(enumerate(labeled_tables), total=total):
         # there should usually be labels, but there might not be, in which case don't filter anything...
-        if table.get("labels") is not None:
-            for filter_fn in filters:
-                if not table["labels"][filter_fn.__name__]:
-                    should_skip_table = True
-                    break
-        if should_skip_table:
+        labels = table.get("labels")
+        if table_i == 0 and labels is None:
+            print("Unable to find labels on the tables. All are being converted to json.")
+        if labels is not None and not all(labels[name] for name in filter_names):
             continue
 
         if "table_html" not in table:
             table_soup = soupify(table["xml"])
         else:
             table_soup = soupify(table["table_html"])
-        cites = table_soup.find_all("cit")
+        cites = FIND_CITS(table_soup)
         cite_shas = [cite.get("sha") for cite in cites]
+        cite_id_map = {bib_ref[:7]: bib_ref for bib_ref in cite_shas if bib_ref is not None}
 
         try:
             with warnings.catch_warnings(action="ignore"):
@@ -707,7 +902,7 @@ def create_dataset(labeled_tables, filters):
             skipped_table_hashes.append(table["_table_hash"])
             continue
         # trp = table_requires_paper(table_json)
-        row_bib_map = get_table_row_bib_map(table_json["table_dict"], cite_shas, table["paper_id"])
+        row_bib_map = get_table_row_bib_map(table_json["table_dict"], cite_id_map, table["paper_id"])
 
         new_sample = {
             "paper_id": table["paper_id"],
@@ -724,7 +919,7 @@ def create_dataset(labeled_tables, filters):
             new_sample["in_text_ref"] = table["in_text_ref"]
 
         new_sample |= {
-            "table_html": str(table_soup),
+            "table_html": soup_to_str(table_soup),
             "table_json": table_json,
             "row_bib_map": row_bib_map,
             "bib_hash": cite_shas,
@@ -743,14 +938,13 @@ def create_dataset(labeled_tables, filters):
                 row["corpus_id"] = paper_info["corpus_id"]
                 row["title"] = paper_info["title"]
                 row["abstract"] = paper_info["abstract"]
-        dataset.append(new_sample)
+        yield new_sample
 
     print(f"Skipped {len(skipped_table_hashes)} tables")
     print(f"E.g. {skipped_table_hashes[:10]} ...")
     print()
     print(f"Missing {len(missing_bib_hashes)} bib_hashes or arxiv_ids")
     print(f"E.g. {missing_bib_hashes[:10]} ...")
-    return dataset
     
     # for paper_i, paper in enumerate(tables_by_paper):
     #     for table_key in paper["tables"]:
@@ -786,228 +980,362 @@ def create_dataset(labeled_tables, filters):
     # return dataset
 
 
-DEFAULT_POST_JSON_FILTERS = ["no_formula", "has_caption", "no_no_cite", "no_dup"]
-
-
-def get_high_quality_tables(valid_tables_with_jsons, filters=None):
-    # reloading data
-    # print("reloading data...")
-    # with open("arxiv_dump/out_xml_fulltext_filtered/valid_tables_json.jsonl") as f:
-    #     valid_tables_with_jsons = [json.loads(line) for line in f]
-    # print("Done")
-
-    seen_table_strs = set()
-    high_quality_tables = []
-    if filters is None:
-        filters = DEFAULT_POST_JSON_FILTERS
-
-    valid_corpus_ids = []
-    if "rows_no_missing_full_texts" in filters:
-        for filename in [
-            "data/v2/metric_validation_0/full_texts_corpus_ids.jsonl",
-            "data/v2/metric_validation_1/full_texts_corpus_ids.jsonl",
-            "data/v2/highest_quality_tables_1k/full_texts_corpus_ids.jsonl",
-        ]:
-            with open(filename) as f:
-                valid_corpus_ids.extend([json.loads(line)["corpusId"] for line in f])
-
-    for table_i, table in enumerate(valid_tables_with_jsons):
-
-        table_str = "\n".join(
-            [
-                "\t".join([colname] + table["table_json"]["table_dict"][colname])
-                for colname in table["table_json"]["table_dict"]
-            ]
-        )
+def iter_table_strs(table_dict):
+    """
+    Yields the column names and cells of `table_dict`. The substrings that `get_high_quality_tables` looks for
+    can't span two of these, so they're checked one at a time (stopping at the first match) instead of joining
+    the whole table into one string.
+    """
+    for colname, cells in table_dict.items():
+        yield colname
+        yield from cells
 
-        # remove tables with formulas
-        if "no_formula" in filters and "{{formula:" in table_str:
-            continue
 
-        # ensure the table has a caption
-        if "has_caption" in filters and table["caption"] == "NO_CAPTION" or not table["caption"].strip():
-            continue
+def replace_cites(text, replacement="[cite]"):
+    """
+    Replaces the citations in `text` with `replacement`. Same as `ANY_CITE_RE.sub(replacement, text)`, but the
+    citations have a fixed length ("{{cite:" + 7 characters + "}}"), so they're found with `str.find` instead.
+    """
+    pieces = []
+    last = 0
+    idx = text.find("{{cite:")
+    while idx != -1:
+        # `.` in ANY_CITE_RE doesn't match newlines
+        if text.startswith("}}", idx + 14) and "\n" not in text[idx + 7 : idx + 14]:
+            pieces.append(text[last:idx])
+            pieces.append(replacement)
+            last = idx + 16
+            idx = text.find("{{cite:", last)
+        else:
+            idx = text.find("{{cite:", idx + 1)
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return "".join(pieces)
 
-        # ensure table has an in-text reference
-        if "has_in_text_ref" in filters and not table["in_text_ref"]:
-            continue
 
-        # for now, ignore tables that are missing citations
-        if "no_no_cite" in filters and "no_cite" in table_str:
-            continue
+DEFAULT_POST_JSON_FILTERS = ["no_formula", "has_caption", "no_no_cite", "no_dup"]
 
-        if "max_one_no_cite" in filters and table_str.count("no_cite") > 1:
-            continue
+# (lowercased) names of columns that list the cited papers' authors or references rather than an aspect of them
+NAME_COL_NAMES = frozenset(
+    {
+        "reference",
+        "author",
+        "reference-(5)",
+        "author/reference",
+    }
+)
+# names of columns with generic metadata about the cited papers
+GENERIC_COL_NAMES = frozenset(
+    {
+        "Venue",
+        "Month",
+        "Year",
+        "No.",
+        "[HTML]D0CECE\nYear",
+        "Title",
+        "URL",
+        "[HTML]BBDAFFYear",
+        "Link",
+        "Version",
+        "Organiser",
+        "Citations",
+        "Pub.",
+        "Title of Survey Article",
+        "License",
+        "Publication",
+    }
+)
 
-        # ignore tables that have merged headers
-        if "no_merged_headers" in filters and any(
-            ["-" in header for header in table["table_json"]["table_dict"].keys()]
-        ):
+def filter_high_quality_table(table, filters, valid_corpus_ids):
+    """
+    Applies the `filters` (a frozenset) to a single table from `get_high_quality_tables`. Returns None if the
+    table is filtered out, and otherwise a (table, table_digest) pair with the filtered copy of the table and,
+    if "no_dup" is in `filters`, a digest of its text (without citations) used to find duplicate tables.
+    """
+    # the filters checked inside the row and column loops are looked up once up front
+    rows_no_missing_titles = "rows_no_missing_titles" in filters
+    rows_no_missing_abstracts = "rows_no_missing_abstracts" in filters
+    rows_no_missing_full_texts = "rows_no_missing_full_texts" in filters
+    check_formula = "cols_no_formula" in filters
+    check_float = "cols_no_float" in filters
+    check_figure = "cols_no_figure" in filters
+    cols_no_formula_colname = "cols_no_formula_colname" in filters
+    cols_no_names = "cols_no_names" in filters
+    col_no_generic = "col_no_generic" in filters
+    cols_no_ent_or_gen = "cols_no_ent_or_gen" in filters
+    cols_no_numeric = "cols_no_numeric" in filters
+    # bound once here rather than looked up for every cell
+    float_search = FLOAT_REGEX.search
+
+    # the parts of the table that are used below, looked up once
+    table_json = table["table_json"]
+    table_dict = table_json["table_dict"]
+    row_bib_map = table["row_bib_map"]
+    caption = table["caption"]
+    # tables that couldn't be parsed have an empty table_dict (and so no references)
+    refs = table_dict.get("References")
+    if refs is None:
+        return None
+
+    # the checks are ordered from cheapest to most expensive, so most rejected tables never reach the row and
+    # column loops
+    # ensure the table has a caption
+    if "has_caption" in filters and caption == "NO_CAPTION" or not caption.strip():
+        return None
+
+    # ensure table has an in-text reference
+    if "has_in_text_ref" in filters and not table["in_text_ref"]:
+        return None
+
+    # ignore tables that have merged headers
+    if "no_merged_headers" in filters and any("-" in header for header in table_dict):
+        return None
+
+    # ignore tables that are too small. Removing rows can only make them smaller, so check the bounds before
+    # looking at the rows at all
+    num_refs = len(refs)
+    if "more_than_two_rows" in filters and num_refs < 2:
+        return None
+
+    num_uniq_refs = len(set(refs))
+    if "more_than_two_uniq_rows" in filters and num_uniq_refs < 2:
+        return None
+
+    # remove tables with formulas
+    if "no_formula" in filters and any("{{formula:" in text for text in iter_table_strs(table_dict)):
+        return None
+
+    # for now, ignore tables that are missing citations
+    if "no_no_cite" in filters and any("no_cite" in text for text in iter_table_strs(table_dict)):
+        return None
+
+    if "max_one_no_cite" in filters and sum(text.count("no_cite") for text in iter_table_strs(table_dict)) > 1:
+        return None
+
+    # if the reference column contains no citations, then skip the table as well.
+    if all(cell.strip() == "-" for cell in refs):
+        return None
+
+    # if the table cites papers we don't have title & abstract for, then skip
+    try:
+        if "no_missing_titles" in filters and any(row["title"] is None for row in row_bib_map):
+            return None
+    except KeyError:
+        print("key error:", table["_table_hash"])
+        return None
+
+    if "no_missing_abstracts" in filters and any(row["abstract"] is None for row in row_bib_map):
+        return None
+
+    # edit the rows and bibmap to remove rows missing titles and/or abstracts
+    remove_rows = set()
+    remove_unique_hashes = set()
+    new_row_bib_map = []
+    for row in row_bib_map:
+        should_remove_row = False
+        if rows_no_missing_titles and row["title"] is None:
+            should_remove_row = True
+            remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
+        if rows_no_missing_abstracts and row["abstract"] is None:
+            should_remove_row = True
+            remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
+        if rows_no_missing_full_texts and row["corpus_id"] not in valid_corpus_ids:
+            should_remove_row = True
+            remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
+
+        if should_remove_row:
+            remove_rows.add(row["row"])
+        else:
+            new_row = {k: v for k, v in row.items()}
+            new_row["row"] = len(new_row_bib_map)
+            new_row_bib_map.append(new_row)
+
+    # now check the sizes again with the removed rows
+    if "more_than_two_rows" in filters and num_refs - len(remove_rows) < 2:
+        return None
+
+    if "more_than_two_uniq_rows" in filters and num_uniq_refs - len(remove_unique_hashes) < 2:
+        return None
+
+    # do some post processing by removing columns that only contain additional citations
+    remove_cols = set()
+    if "cols_no_old_citation_col" in filters:
+        remove_cols.add(table_json["old_citation_column"])
+
+    for col, cells in table_dict.items():
+        # the references column is always kept, so there's nothing to check. Each column is only removed once, so
+        # the checks below move on to the next column as soon as one of them removes it
+        if col == "References" or col in remove_cols:
             continue
 
-        # if the reference column contains no citations, then skip the table as well.
-        table_dict = table["table_json"]["table_dict"]
-        if all([cell.strip() == "-" for cell in table_dict["References"]]):
+        # the checks that only look at the header come first
+        # also remove colums whose headers are just numbers...
+        if NUMBER_COL_RE.fullmatch(col) is not None:
+            remove_cols.add(col)
             continue
 
-        # if the table cites papers we don't have title & abstract for, then skip
-        try:
-            if "no_missing_titles" in filters and any([row["title"] is None for row in table["row_bib_map"]]):
-                continue
-        except KeyError:
-            print("key error:", table["_table_hash"])
+        if cols_no_formula_colname and "{{formula:" in col:
+            remove_cols.add(col)
             continue
 
-        if "no_missing_abstracts" in filters and any([row["abstract"] is None for row in table["row_bib_map"]]):
+        col_lower = col.lower()
+        if cols_no_names and col_lower in NAME_COL_NAMES:
+            remove_cols.add(col)
             continue
-
-        # edit the rows and bibmap to remove rows missing titles and/or abstracts
-        remove_rows = []
-        remove_unique_hashes = set()
-        new_row_bib_map = []
-        for row in table["row_bib_map"]:
-            should_remove_row = False
-            if "rows_no_missing_titles" in filters and row["title"] is None:
-                should_remove_row = True
-                remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
-            if "rows_no_missing_abstracts" in filters and row["abstract"] is None:
-                should_remove_row = True
-                remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
-            if "rows_no_missing_full_texts" in filters and row["corpus_id"] not in valid_corpus_ids:
-                should_remove_row = True
-                remove_unique_hashes.add(row["bib_hash_or_arxiv_id"])
-
-            if should_remove_row:
-                remove_rows.append(row["row"])
-            else:
-                new_row = {k: v for k, v in row.items()}
-                new_row["row"] = len(new_row_bib_map)
-                new_row_bib_map.append(new_row)
-
-        # ignore tables that are too small
-        if (
-            "more_than_two_rows" in filters
-            and len(table["table_json"]["table_dict"]["References"]) - len(remove_rows) < 2
-        ):
+        if col_no_generic and (col in GENERIC_COL_NAMES or col_lower in NAME_COL_NAMES):
+            remove_cols.add(col)
             continue
 
-        if (
-            "more_than_two_uniq_rows" in filters
-            and len(set(table["table_json"]["table_dict"]["References"])) - len(remove_unique_hashes) < 2
-        ):
-            continue
-        # do some post processing by removing columns that only contain additional citations
-        remove_cols = []
-
-        for col in table_dict.keys():
-            # always remove cells that only include additional citations
-            if all(
-                [
-                    cell.strip() == "-" or re.sub(r"(and|[,])", "", cell).strip().startswith("{{cite:")
-                    for cell in table_dict[col]
-                ]
+        # collect everything the column checks need in a single pass over the cells (the header is checked
+        # up front). The loop stops as soon as none of the flags can change anymore
+        only_cites = True
+        has_formula = check_formula and "{{formula:" in col
+        has_float = check_float and float_search(col) is not None
+        has_figure = check_figure and r"{{figure" in col
+        for cell in cells:
+            if only_cites:
+                # strip once and reuse it (the "and"s and commas removed below never touch the whitespace)
+                stripped = cell.strip()
+                if stripped != "-" and not CITE_AND_COMMA_RE.sub("", stripped).strip().startswith("{{cite:"):
+                    only_cites = False
+            if check_formula and not has_formula and "{{formula:" in cell:
+                has_formula = True
+            if check_float and not has_float and float_search(cell) is not None:
+                has_float = True
+            if check_figure and not has_figure and r"{{figure" in cell:
+                has_figure = True
+            if (
+                not only_cites
+                and has_formula == check_formula
+                and has_float == check_float
+                and has_figure == check_figure
             ):
-                remove_cols.append(col)
+                break
 
-            # also remove colums whose headers are just numbers...
-            if re.match(r"\d+$", col) is not None:
-                remove_cols.append(col)
+        # always remove cells that only include additional citations
+        if only_cites or has_formula or has_float or has_figure:
+            remove_cols.add(col)
+            continue
 
-            if "cols_no_formula" in filters and any(["{{formula:" in cell for cell in table_dict[col] + [col]]):
-                remove_cols.append(col)
+        # the aspect type is the most expensive check, so it's only computed for the columns that are left
+        if cols_no_ent_or_gen or cols_no_numeric:
+            aspect_type = get_aspect_type(cells)
+            if cols_no_numeric and aspect_type == "num":
+                remove_cols.add(col)
+            elif cols_no_ent_or_gen and aspect_type in {"gen", "ent"}:
+                remove_cols.add(col)
+
+    kept_cols = [col for col in table_dict if col == "References" or col not in remove_cols]
+
+    # filter out tables that don't have enough columns (references, something, something) - need at least three.
+    # This only needs the number of kept columns, so it's checked before any of the columns are copied
+    min_rows = 2 if cols_no_ent_or_gen or cols_no_numeric else 3
+    if len(kept_cols) < min_rows:
+        return None
+
+    if remove_rows:
+        new_table_dict = {
+            col: [val for row_i, val in enumerate(table_dict[col]) if row_i not in remove_rows] for col in kept_cols
+        }
+    else:
+        new_table_dict = {col: list(table_dict[col]) for col in kept_cols}
 
-            if "cols_no_formula_colname" in filters and "{{formula:" in col:
-                remove_cols.append(col)
+    # the duplicates are dropped by the caller (which sees all of the tables), so just compute what to compare.
+    # A fixed size digest of the text is kept rather than the (much longer) text itself
+    table_digest = None
+    if "no_dup" in filters:
+        table_str_no_refs = "\n".join(
+            [
+                replace_cites("\t".join([colname] + new_table_dict[colname]))
+                for colname in new_table_dict
+                if colname != "References"
+            ]
+        )
+        table_digest = hashlib.blake2b(table_str_no_refs.encode(), digest_size=16).digest()
 
-            if "cols_no_names" in filters and col.lower() in {
-                "reference",
-                "author",
-                "reference-(5)",
-                "author/reference",
-            }:
-                remove_cols.append(col)
-            if (
-                "col_no_generic" in filters
-                and col
-                in {
-                    "Venue",
-                    "Month",
-                    "Year",
-                    "No.",
-                    "[HTML]D0CECE\nYear",
-                    "Title",
-                    "URL",
-                    "[HTML]BBDAFFYear",
-                    "Link",
-                    "Version",
-                    "Organiser",
-                    "Citations",
-                    "Pub.",
-                    "Title of Survey Article",
-                    "License",
-                    "Publication",
-                }
-                or col.lower
-                in {
-                    "reference",
-                    "author",
-                    "reference-(5)",
-                    "author/reference",
-                }
-            ):
-                remove_cols.append(col)
+    # only the table_dict and row_bib_map are replaced, so the rest of the table can be shared with the input
+    table_cp = dict(table)
+    table_cp["table_json"] = dict(table_json)
+    table_cp["table_json"]["table_dict"] = new_table_dict
+    table_cp["row_bib_map"] = new_row_bib_map
+    return table_cp, table_digest
 
-            if "cols_no_old_citation_col" in filters:
-                remove_cols.append(table["table_json"]["old_citation_column"])
+def load_valid_corpus_ids():
+    """Returns the corpus ids of the papers we have full texts for (used by the "rows_no_missing_full_texts" filter)."""
+    valid_corpus_ids = []
+    for filename in [
+        "data/v2/metric_validation_0/full_texts_corpus_ids.jsonl",
+        "data/v2/metric_validation_1/full_texts_corpus_ids.jsonl",
+        "data/v2/highest_quality_tables_1k/full_texts_corpus_ids.jsonl",
+    ]:
+        with open(filename, "rb") as f:
+            valid_corpus_ids.extend([_loads(line)["corpusId"] for line in f])
+    return frozenset(valid_corpus_ids)
 
-            if "cols_no_float" in filters and any([FLOAT_REGEX.search(cell) for cell in table_dict[col] + [col]]):
-                remove_cols.append(col)
 
-            if "cols_no_figure" in filters and any([r"{{figure" in cell for cell in table_dict[col] + [col]]):
-                remove_cols.append(col)
+def filter_quality_tables(table, filter_sets, valid_corpus_ids):
+    """Applies each of the `filter_sets` to `table`, returning a `filter_high_quality_table` result for each."""
+    return [filter_high_quality_table(table, filters, valid_corpus_ids) for filters in filter_sets]
 
-            if "cols_no_ent_or_gen" in filters or "cols_no_numeric" in filters:
-                aspect_type = get_aspect_type(table_dict[col])
-                if "cols_no_numeric" in filters and aspect_type == "num":
-                    remove_cols.append(col)
-                if "cols_no_ent_or_gen" in filters and aspect_type in {"gen", "ent"}:
-                    remove_cols.append(col)
 
-            if "cols_no_numeric" in filters:
-                pass
+def get_quality_datasets(valid_tables_with_jsons, filter_sets, num_processes=1):
+    """
+    Like `get_high_quality_tables`, but creates one dataset for each of the `filter_sets` in a single pass over
+    `valid_tables_with_jsons`. Returns a list with the datasets in the same order as `filter_sets`.
+    """
+    # the filters are checked for every table (and every row and column), so make the lookups O(1)
+    filter_sets = [frozenset(filters) for filters in filter_sets]
+
+    valid_corpus_ids = frozenset()
+    if any("rows_no_missing_full_texts" in filters for filters in filter_sets):
+        valid_corpus_ids = load_valid_corpus_ids()
+
+    process_table = functools.partial(filter_quality_tables, filter_sets=filter_sets, valid_corpus_ids=valid_corpus_ids)
+    if num_processes > 1:
+        # `imap` (rather than `imap_unordered`) keeps the tables in order, so the same duplicates are dropped
+        with multiprocessing.Pool(num_processes) as pool:
+            results = list(pool.imap(process_table, valid_tables_with_jsons, chunksize=64))
+    else:
+        results = map(process_table, valid_tables_with_jsons)
 
-        new_table_dict = {}
-        for col in table_dict.keys():
-            if col in remove_cols and col != "References":
+    datasets = [[] for _ in filter_sets]
+    seen_digests = [set() for _ in filter_sets]
+    for table_results in results:
+        for dataset, seen, result in zip(datasets, seen_digests, table_results):
+            if result is None:
                 continue
+            table_cp, table_digest = result
 
-            new_table_dict[col] = [val for row_i, val in enumerate(table_dict[col]) if row_i not in remove_rows]
+            # don't add tables that have already been added
+            if table_digest is not None:
+                if table_digest in seen:
+                    continue
+                seen.add(table_digest)
 
-        # filter out tables that don't have enough columns (references, something, something) - need at least three
-        min_rows = 2 if "cols_no_ent_or_gen" in filters or "cols_no_numeric" in filters else 3
-        if len(new_table_dict) < min_rows:
-            continue
+            dataset.append(table_cp)
+
+    # the digests aren't needed anymore, so don't keep them around until the caller is done with the datasets
+    for seen in seen_digests:
+        seen.clear()
+    del seen_digests
+    return datasets
 
-        # don't add tables that have already been added
-        if "no_dup" in filters:
-            table_str_no_refs = "\n".join(
-                [
-                    re.sub(r"{{cite:.{7}}}", "[cite]", "\t".join([colname] + new_table_dict[colname]))
-                    for colname in new_table_dict
-                    if colname != "References"
-                ]
-            )
-            if table_str_no_refs in seen_table_strs:
-                continue
-            else:
-                seen_table_strs.add(table_str_no_refs)
 
-        table_cp = copy.deepcopy(table)
-        table_cp["table_json"]["table_dict"] = new_table_dict
-        table_cp["row_bib_map"] = new_row_bib_map
-        high_quality_tables.append(table_cp)
+def get_high_quality_tables(valid_tables_with_jsons, filters=None, num_processes=1):
+    """
+    Returns the tables in `valid_tables_with_jsons` that pass the `filters`. If `num_processes` > 1, the
+    tables are filtered in a pool of that many processes.
+    """
+    # reloading data
+    # print("reloading data...")
+    # with open("arxiv_dump/out_xml_fulltext_filtered/valid_tables_json.jsonl") as f:
+    #     valid_tables_with_jsons = [json.loads(line) for line in f]
+    # print("Done")
 
-    return high_quality_tables
+    if filters is None:
+        filters = DEFAULT_POST_JSON_FILTERS
+    return get_quality_datasets(valid_tables_with_jsons, [filters], num_processes=num_processes)[0]
 
 
 def run(
@@ -1020,11 +1348,15 @@ def run(
     should_label,
     should_filter,
     should_create_quality_datasets,
+    num_label_processes=1,
+    num_quality_processes=1,
 ):
     # labeling
     if should_label:
         assert out_labeled_path is not None
-        labeled_tables = extract_valid_tables(in_path, DEFAULT_TABLE_LABELS, label_tables=True)
+        labeled_tables = extract_valid_tables(
+            in_path, DEFAULT_TABLE_LABELS, label_tables=True, num_processes=num_label_processes
+        )
         labeled_tables_dataset = []
         for paper_i, paper in enumerate(labeled_tables):
 
@@ -1044,40 +1376,37 @@ def run(
                         "_source_hash": paper["_source_hash"],
                         "_source_name": paper["_source_name"],
                         "_table_hash": table_key,
-                        "table_html": str(paper["tables"][table_key]["soup"]),
+                        "table_html": paper["tables"][table_key]["table_html"],
                         "labels": paper["tables"][table_key]["labels"],
                         "caption": paper["tables"][table_key]["caption"],
                         "in_text_ref": in_text_refs_by_table_id[table_key],
                     }
                 )
-        with open(out_labeled_path, "w") as f:
-            for sample in labeled_tables_dataset:
-                f.write(json.dumps(sample) + "\n")
+        write_jsonl(out_labeled_path, labeled_tables_dataset)
 
     elif should_filter:
-        # assumes that `in_path` has labels
-        if os.path.splitext(in_path)[1] == ".gz":
-            f = gzip.open(in_path, "r")
-        else:
-            f = open(in_path)
-        # with open(in_path) as f:
-        labeled_tables_dataset = [json.loads(line) for line in f]
-        f.close()
+        # assumes that `in_path` has labels. The tables are only needed for one pass, so they're streamed
+        labeled_tables_dataset = iter_jsonl(in_path)
 
     # filtering
     if should_filter:
         assert out_filtered_path is not None
-        filtered_tables_dataset = create_dataset(labeled_tables_dataset, DEFAULT_TABLE_FILTERS)
-
-        with open(out_filtered_path, "w") as f:
-            for sample in filtered_tables_dataset:
-                f.write(json.dumps(sample) + "\n")
+        quality_paths = [out_high_quality_path, out_high_quality_schemes_path, out_mid_quality_path]
+        if should_create_quality_datasets and any(path is not None for path in quality_paths):
+            # the quality datasets are made from the filtered tables in a single pass, so each table is written
+            # as it's passed along rather than keeping all of them in memory
+            filtered_tables_dataset = iter_and_write_jsonl(
+                out_filtered_path, iter_dataset(labeled_tables_dataset, DEFAULT_TABLE_FILTERS)
+            )
+        else:
+            write_dataset_jsonl(out_filtered_path, labeled_tables_dataset, DEFAULT_TABLE_FILTERS)
     elif should_create_quality_datasets:
-        # assumes that `in_path` has jsons
-        with open(in_path) as f:
-            filtered_tables_dataset = [json.loads(line) for line in f]
+        # assumes that `in_path` has jsons. The quality datasets are created in one pass, so the tables are streamed
+        filtered_tables_dataset = iter_jsonl(in_path)
 
     if should_create_quality_datasets:
+        # (name, out_path, filters) for each of the quality datasets to create
+        quality_datasets = []
         if out_high_quality_path is not None:
             filters_hq = [
                 "no_formula",
@@ -1149,14 +1478,7 @@ def run(
             #     # "no_missing_titles",
             #     # "no_missing_abstracts",
             # ]
-            dataset_hq = get_high_quality_tables(filtered_tables_dataset, filters_hq)
-            print("Size of High Quality dataset:", len(dataset_hq))
-            with open(out_high_quality_path, "w") as f:
-                for sample in dataset_hq:
-                    f.write(json.dumps(sample) + "\n")
-
-            with open(os.path.splitext(out_high_quality_path)[0] + "_filters.json", "w") as f:
-                json.dump(filters_hq, f)
+            quality_datasets.append(("High Quality dataset", out_high_quality_path, filters_hq))
 
         if out_high_quality_schemes_path is not None:
             filters_high_quality_schemes = [
@@ -1175,17 +1497,9 @@ def run(
                 # "rows_no_missing_titles",
                 # "rows_no_missing_abstracts",
             ]
-            dataset_high_quality_schemes = get_high_quality_tables(
-                filtered_tables_dataset,
-                filters_high_quality_schemes,
+            quality_datasets.append(
+                ("dataset_high_quality_schemes", out_high_quality_schemes_path, filters_high_quality_schemes)
             )
-            print("Size of dataset_high_quality_schemes:", len(dataset_high_quality_schemes))
-            with open(out_high_quality_schemes_path, "w") as f:
-                for sample in dataset_high_quality_schemes:
-                    f.write(json.dumps(sample) + "\n")
-
-            with open(os.path.splitext(out_high_quality_schemes_path)[0] + "_filters.json", "w") as f:
-                json.dump(filters_high_quality_schemes, f)
 
         if out_mid_quality_path is not None:
             filters_mid_quality = [
@@ -1202,15 +1516,26 @@ def run(
                 "rows_no_missing_abstracts",
                 # "cols_no_old_citation_col",
             ]
-            dataset_mid_quality_tables = get_high_quality_tables(filtered_tables_dataset, filters_mid_quality)
-            print("Size of dataset_mid_quality_tables:", len(dataset_mid_quality_tables))
-            print(f"Saved to {out_mid_quality_path}")
-            with open(out_mid_quality_path, "w") as f:
-                for sample in dataset_mid_quality_tables:
-                    f.write(json.dumps(sample) + "\n")
+            quality_datasets.append(("dataset_mid_quality_tables", out_mid_quality_path, filters_mid_quality))
+
+        # all of the quality datasets are built in a single pass over the filtered tables
+        if quality_datasets:
+            datasets = get_quality_datasets(
+                filtered_tables_dataset,
+                [filters for _, _, filters in quality_datasets],
+                num_processes=num_quality_processes,
+            )
+            del filtered_tables_dataset
+            for name, out_path, filters in quality_datasets:
+                # each dataset is released as soon as it's written, rather than after all of them are
+                dataset = datasets.pop(0)
+                print(f"Size of {name}:", len(dataset))
+                print(f"Saved to {out_path}")
+                write_jsonl(out_path, dataset)
+                del dataset
 
-            with open(os.path.splitext(out_mid_quality_path)[0] + "_filters.json", "w") as f:
-                json.dump(filters_mid_quality, f)
+                with open(os.path.splitext(out_path)[0] + "_filters.json", "w") as f:
+                    json.dump(filters, f)
 
 
 BLACK_LIST = [
@@ -1224,6 +1549,15 @@ BLACK_LIST = [
 ]
 
 
+# number of input files a worker processes before it's replaced by a fresh process
+MAX_TASKS_PER_CHILD = 4
+
+
+def run_task(task):
+    """Calls `run` with the arguments in the `task` tuple (for `Pool.imap_unordered`, which passes one argument)."""
+    return run(*task)
+
+
 def main():
     argp = ArgumentParser()
     argp.add_argument("in_path", type=str)
@@ -1236,6 +1570,18 @@ def main():
     argp.add_argument("--filter", action="store_true")
     argp.add_argument("--create_quality_datasets", action="store_true")
     argp.add_argument("--num_processes", type=int, default=1)
+    argp.add_argument(
+        "--num_label_processes",
+        type=int,
+        default=1,
+        help="number of processes used to label the tables of a single in_path (only when --num_processes is 1)",
+    )
+    argp.add_argument(
+        "--num_quality_processes",
+        type=int,
+        default=1,
+        help="number of processes used to create the quality datasets of a single in_path (only when --num_processes is 1)",
+    )
     args = argp.parse_args()
 
     if not args.label and not args.filter and not args.create_quality_datasets:
@@ -1254,44 +1600,45 @@ def main():
             args.label,
             args.filter,
             args.create_quality_datasets,
+            args.num_label_processes,
+            args.num_quality_processes,
         )
     else:
         # assume in_path contains the in_paths we care about
-        with multiprocessing.Pool(processes=args.num_processes) as pool:
-            results = []
-            for in_path in os.listdir(args.in_path):
-                if in_path in BLACK_LIST:
-                    print(f"Skipping {in_path}")
-                    continue
-                out_labeled_path = (
-                    os.path.join(args.out_labeled_path, in_path.split(".")[0]) + ".jsonl"
-                    if args.out_labeled_path is not None
-                    else None
-                )
-                out_filtered_path = (
-                    os.path.join(args.out_filtered_path, in_path.split(".")[0]) + ".jsonl"
-                    if args.out_filtered_path is not None
-                    else None
-                )
-                out_high_quality_path = (
-                    os.path.join(args.out_high_quality_path, in_path.split(".")[0]) + ".jsonl"
-                    if args.out_high_quality_path is not None
-                    else None
-                )
-                out_high_quality_schemes_path = (
-                    os.path.join(args.out_high_quality_schemes_path, in_path.split(".")[0]) + ".jsonl"
-                    if args.out_high_quality_schemes_path is not None
-                    else None
-                )
-                out_mid_quality_path = (
-                    os.path.join(args.out_mid_quality_path, in_path.split(".")[0]) + ".jsonl"
-                    if args.out_mid_quality_path is not None
-                    else None
-                )
-                print("In:", os.path.join(args.in_path, in_path))
-                print("out:", out_labeled_path)
-                runner = functools.partial(
-                    run,
+        tasks = []
+        for in_path in os.listdir(args.in_path):
+            if in_path in BLACK_LIST:
+                print(f"Skipping {in_path}")
+                continue
+            out_labeled_path = (
+                os.path.join(args.out_labeled_path, in_path.split(".")[0]) + ".jsonl"
+                if args.out_labeled_path is not None
+                else None
+            )
+            out_filtered_path = (
+                os.path.join(args.out_filtered_path, in_path.split(".")[0]) + ".jsonl"
+                if args.out_filtered_path is not None
+                else None
+            )
+            out_high_quality_path = (
+                os.path.join(args.out_high_quality_path, in_path.split(".")[0]) + ".jsonl"
+                if args.out_high_quality_path is not None
+                else None
+            )
+            out_high_quality_schemes_path = (
+                os.path.join(args.out_high_quality_schemes_path, in_path.split(".")[0]) + ".jsonl"
+                if args.out_high_quality_schemes_path is not None
+                else None
+            )
+            out_mid_quality_path = (
+                os.path.join(args.out_mid_quality_path, in_path.split(".")[0]) + ".jsonl"
+                if args.out_mid_quality_path is not None
+                else None
+            )
+            print("In:", os.path.join(args.in_path, in_path))
+            print("out:", out_labeled_path)
+            tasks.append(
+                (
                     os.path.join(args.in_path, in_path),
                     out_labeled_path,
                     out_filtered_path,
@@ -1302,13 +1649,13 @@ def main():
                     args.filter,
                     args.create_quality_datasets,
                 )
-                result = pool.apply_async(runner)
-                results.append(result)
-            for result in results:
-                result.get()
-            pool.close()
-            pool.join()
+            )
 
+        # each file is one task, handed out as workers free up. Workers are replaced after a few files so the
+        # memory held on to from earlier files is released
+        with multiprocessing.Pool(processes=args.num_processes, maxtasksperchild=MAX_TASKS_PER_CHILD) as pool:
+            for _ in pool.imap_unordered(run_task, tasks, chunksize=1):
+                pass
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,99 @@
 from argparse import ArgumentParser
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
 import gzip
+import io
 import json
+import multiprocessing
 import os
 from pathlib import Path
 import re
+import sqlite3
+import threading
 import requests_cache
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from nltk import word_tokenize, edit_distance
+from urllib3.util.retry import Retry
+
+try:
+    # word-level levenshtein distance in C (the same distance as nltk's `edit_distance`)
+    from rapidfuzz.distance.Levenshtein import distance as edit_distance
+except ImportError:
+    from nltk import edit_distance
 
 import time
 
 from tqdm import trange
-import pandas as pd
 
-BATCH_SIZE = 100
+try:
+    # pyarrow's csv reader is multithreaded, and much faster than pandas'
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    import pandas as pd
+
+    pacsv = None
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+except ImportError:
+    _loads = json.loads
 
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
 
-session = requests_cache.CachedSession("titles_ids_cache")
+try:
+    # rapidgzip decompresses a single .gz file on several cores at once
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+BATCH_SIZE = 100
+# the public search api allows about one request per second (with an api key). The searches are spread over
+# several threads so the requests' latency overlaps, but the rate limiter keeps them under the limit
+S2_REQUESTS_PER_SECOND = 1.0
+NUM_SEARCH_WORKERS = 8
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 5
+SAVE_EVERY = 100  # number of searched titles between saves of the responses
+
+
+# responses are cached on disk, so rerunning any of the `main_*`s only hits S2 for requests it hasn't made before.
+# WAL mode lets the search threads read from the cache while it's being written to
+S2_CACHE_EXPIRE_AFTER = 7 * 24 * 60 * 60  # seconds
+session = requests_cache.CachedSession(
+    "titles_ids_cache",
+    backend="sqlite",
+    wal=True,
+    expire_after=S2_CACHE_EXPIRE_AFTER,
+    allowable_methods=("GET", "POST"),
+    cache_control=True,
+)
+# keep a connection open for each of the search threads. `request_s2` retries the responses that say the server is
+# overloaded or rate-limiting us, so urllib3 only retries (with backoff) requests that fail to connect or get a
+# response at all
+adapter = HTTPAdapter(
+    pool_connections=NUM_SEARCH_WORKERS,
+    pool_maxsize=NUM_SEARCH_WORKERS,
+    max_retries=Retry(total=MAX_RETRIES, backoff_factor=0.5, allowed_methods=("GET", "POST")),
+)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
 S2_API_KEY = "API-KEY"
+S2_HEADERS = {"x-api-key": S2_API_KEY}
+S2_BATCH_URL = "https://api.semanticscholar.org/graph/v1/paper/batch"
+# the same fields that `get_metadata_local` fills in
+S2_BATCH_FIELDS = "corpusId,externalIds,title,abstract,isOpenAccess,openAccessPdf"
+S2_MAX_BATCH_SIZE = 500  # the most ids the batch endpoint accepts in one request
+ARXIV_VERSION_RE = re.compile(r"v\d+")
 
 def get_titles_s2_internal(citations_batch):
     """
@@ -57,13 +131,13 @@ def get_corpus_ids_s2_internal(titles_batch):
     return corpus_ids
 
 
-def get_metadata_s2_public(corpus_ids_batch, prefix="CorpusId:"):
+def get_metadata_s2_public(corpus_ids_batch, prefix="CorpusId:", rate_limiter=None):
     """
-    Can be run off of S2 network
+    Can be run off of S2 network. `corpus_ids_batch` can have up to `S2_MAX_BATCH_SIZE` ids.
     """
     ids_json = {"ids": [f"{prefix}{corpus_id}" for corpus_id in corpus_ids_batch]}
-    headers = {"x-api-key": S2_API_KEY}
-    response = session.post(base_url, json=ids_json, headers=headers)
+    params = {"fields": S2_BATCH_FIELDS}
+    response = request_s2("POST", S2_BATCH_URL, rate_limiter, params=params, json=ids_json, headers=S2_HEADERS)
     metadata = response.json()
 
     try:
@@ -79,74 +153,158 @@ def get_metadata_s2_public(corpus_ids_batch, prefix="CorpusId:"):
     return metadata
 
 
+class RateLimiter:
+    """Spaces out calls to `wait` (across threads) so that at most `rate` happen per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def get_retry_after(response, default=1.0):
+    try:
+        return float(response.headers.get("Retry-After", default))
+    except ValueError:
+        # Retry-After can also be an http date, which we don't bother parsing
+        return default
+
+
+def is_cached(method, url, **kwargs):
+    request = session.prepare_request(requests.Request(method, url, **kwargs))
+    return session.cache.contains(request=request)
+
+
+def request_s2(method, url, rate_limiter=None, **kwargs):
+    """
+    Sends a request through the cached `session`. Only backs off when the server is overloaded or rate-limiting
+    us, and responses that are already cached don't wait on the `rate_limiter`.
+    """
+    for _ in range(MAX_RETRIES):
+        if rate_limiter is not None and not is_cached(method, url, **kwargs):
+            rate_limiter.wait()
+        response = session.request(method, url, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES:
+            break
+        time.sleep(get_retry_after(response))
+    return response
+
+
+def open_gzip(path):
+    """Opens a .gz file for reading bytes, decompressing it in parallel if rapidgzip is installed."""
+    if rapidgzip is not None:
+        return io.BufferedReader(rapidgzip.open(path, parallelization=os.cpu_count()), buffer_size=1 << 20)
+    return gzip.open(path, "rb")
+
+
 def proc_arxiv_md(text):
     return " ".join([line.strip() for line in text.strip().splitlines()])
 
 
 class ArxivMetadata:
-    data = None
+    """
+    The title, abstract, doi and categories of each paper in the arxiv metadata snapshot. The (multi-GB) snapshot
+    is copied into a sqlite database keyed by arxiv id the first time it's used, so afterwards only the papers
+    that are looked up are read.
+    """
+
+    snapshot_path = "../arxiv_dump/arxiv-metadata-oai-snapshot.json"
+    db_path = "../arxiv_dump/arxiv-metadata-oai-snapshot.sqlite"
+    conn = None
+
+    @classmethod
+    def build_sqlite(cls):
+        print("building sqlite database from arxiv metadata snapshot")
+        # build into a temporary file so an interrupted build isn't mistaken for a finished one
+        tmp_path = cls.db_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.execute(
+            "CREATE TABLE metadata (id TEXT PRIMARY KEY, title TEXT, abstract TEXT, doi TEXT, categories TEXT)"
+        )
+        with open(cls.snapshot_path, "rb") as f:
+            rows = (
+                (md["id"], md["title"], md["abstract"], md["doi"], md["categories"])
+                for md in (_loads(line) for line in f)
+            )
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)", rows)
+        conn.close()
+        os.replace(tmp_path, cls.db_path)
 
     @classmethod
     def load(cls):
-        print("loading arxiv metadata snapshot")
-        with open("../arxiv_dump/arxiv-metadata-oai-snapshot.json") as f:
-            arxiv_metadata = [json.loads(line) for line in f]
-            cls.data = {
-                md["id"]: {
-                    "title": md["title"],
-                    "abstract": md["abstract"],
-                    "doi": md["doi"],
-                    "categories": md["categories"],
-                }
-                for md in arxiv_metadata
-            }
+        if not os.path.exists(cls.db_path):
+            cls.build_sqlite()
+        cls.conn = sqlite3.connect(cls.db_path)
 
     @classmethod
-    def get(cls):
-        if cls.data is None:
+    def get(cls, arxiv_id):
+        """Returns the metadata for `arxiv_id` as a dict, or None if it's not in the snapshot."""
+        if cls.conn is None:
             cls.load()
-        return cls.data
+        row = cls.conn.execute(
+            "SELECT title, abstract, doi, categories FROM metadata WHERE id = ?", (arxiv_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("title", "abstract", "doi", "categories"), row))
 
 
 class ArxivIdsS2:
-    data = None
+    csv_path = "../arxiv_dump/athena_results_2024-02-23_arxiv_ids_to_s2_ids.csv"
+    # the csv's rows, as dicts
+    rows = None
+    # key column -> {key: row}, built from `rows` the first time each key column is used
+    rows_by_key = {}
 
     @classmethod
     def load(cls):
-        print("loading pandas dataframe of arixiv_id to corpus_id")
-        cls.data = pd.read_csv(
-            "../arxiv_dump/athena_results_2024-02-23_arxiv_ids_to_s2_ids.csv", index_col="source_id"
-        )
+        print("loading csv of arixiv_id to corpus_id")
+        if pacsv is not None:
+            # pyarrow reads the csv on several threads, and skips building a DataFrame we'd only convert to dicts
+            # arxiv ids are read as strings: otherwise new-style ids (e.g. 2101.00000) are inferred as numbers
+            # and old-style ones (e.g. hep-th/9901001) in a later block fail to parse
+            convert_options = pacsv.ConvertOptions(column_types={"source_id": pa.string()})
+            cls.rows = pacsv.read_csv(cls.csv_path, convert_options=convert_options).to_pylist()
+        else:
+            cls.rows = pd.read_csv(cls.csv_path, dtype={"source_id": str}).to_dict("records")
 
     @classmethod
-    def get(cls):
-        if cls.data is None:
+    def get(cls, key_col="source_id"):
+        """
+        Returns a dict mapping each value of `key_col` ("source_id" or "corpus_paper_id") to its row. Only the
+        first of any duplicate rows is kept. The rows are shared between the key columns' dicts.
+        """
+        if cls.rows is None:
             cls.load()
-        return cls.data
+        if key_col not in cls.rows_by_key:
+            rows_by_key = {}
+            for row in cls.rows:
+                rows_by_key.setdefault(row[key_col], row)
+            cls.rows_by_key[key_col] = rows_by_key
+        return cls.rows_by_key[key_col]
 
 
 def get_metadata_local(corpus_ids_batch, prefix="CorpusId:", verbose=False):
     """
     Can be run offline completely S2 network. Only works for ArXiv papers.
     """
-    arxiv_ids_to_s2_ids = ArxivIdsS2.get()
-    arxiv_metadata = ArxivMetadata.get()
-    if prefix == "ARXIV:" and arxiv_ids_to_s2_ids.index.name != "source_id":
-        arxiv_ids_to_s2_ids.reset_index(inplace=True)
-        arxiv_ids_to_s2_ids.set_index("source_id", inplace=True)
-    elif prefix == "CorpusId:" and arxiv_ids_to_s2_ids.index.name != "corpus_paper_id":
-        arxiv_ids_to_s2_ids.reset_index(inplace=True)
-        arxiv_ids_to_s2_ids.set_index("corpus_paper_id", inplace=True)
+    arxiv_ids_to_s2_ids = ArxivIdsS2.get("source_id" if prefix == "ARXIV:" else "corpus_paper_id")
 
     metadata = []
     for arxiv_id_or_corpus_id in corpus_ids_batch:
-        try:
-            s2_data = arxiv_ids_to_s2_ids.loc[arxiv_id_or_corpus_id]
-            if len(s2_data.shape) > 1:
-                if verbose:
-                    print(f"skipping duplicates (size = {s2_data.shape})")
-                s2_data = s2_data.iloc[0]
-        except KeyError:
+        s2_data = arxiv_ids_to_s2_ids.get(arxiv_id_or_corpus_id)
+        if s2_data is None:
             if verbose:
                 print(f"Skipping {arxiv_id_or_corpus_id}")
             metadata.append({"title": None, "abstract": None, "corpus_id": -1})
@@ -159,12 +317,13 @@ def get_metadata_local(corpus_ids_batch, prefix="CorpusId:", verbose=False):
             arxiv_id = s2_data["source_id"]
             corpus_id = int(arxiv_id_or_corpus_id)
 
-        if arxiv_id not in arxiv_metadata:
+        arxiv_metadata = ArxivMetadata.get(arxiv_id)
+        if arxiv_metadata is None:
             metadata.append({"title": None, "abstract": None, "corpus_id": -1})
             continue
 
-        title = proc_arxiv_md(arxiv_metadata[arxiv_id]["title"])
-        abstract = proc_arxiv_md(arxiv_metadata[arxiv_id]["abstract"])
+        title = proc_arxiv_md(arxiv_metadata["title"])
+        abstract = proc_arxiv_md(arxiv_metadata["abstract"])
         paper_id = s2_data["pdf_hash"]
         metadata.append(
             {
@@ -172,21 +331,51 @@ def get_metadata_local(corpus_ids_batch, prefix="CorpusId:", verbose=False):
                 "externalIds": {
                     "ArXiv": arxiv_id,
                     "CorpusId": corpus_id,
-                    "doi": arxiv_metadata[arxiv_id]["doi"],
+                    "doi": arxiv_metadata["doi"],
                 },
                 "corpusId": corpus_id,
                 "title": title,
                 "abstract": abstract,
                 "isOpenAccess": True,
                 "openAccessPdf": {
-                    "url": json.loads(s2_data["source_uris"])[0],
+                    "url": _loads(s2_data["source_uris"])[0],
                 },
-                "categories": arxiv_metadata[arxiv_id]["categories"],
+                "categories": arxiv_metadata["categories"],
             }
         )
     return metadata
 
 
+# the bib hashes used by the dataset. A global so each worker process gets a copy once, rather than with every shard
+needed_bib_hashes_global = frozenset()
+
+
+def set_needed_bib_hashes(needed_bib_hashes):
+    global needed_bib_hashes_global
+    needed_bib_hashes_global = needed_bib_hashes
+
+
+def load_bib_entries(papers_path):
+    """Returns the bib entries of the papers in the .gz or .jsonl file `papers_path` that the dataset uses."""
+    bib_entries = {}
+    needed_bib_hashes = needed_bib_hashes_global
+    f = open_gzip(papers_path) if os.path.splitext(papers_path)[1] == ".gz" else open(papers_path, "rb")
+    with f:
+        for line in f:
+            # only the paper's bib entries are kept around, so the rest of the (large) parsed paper is freed
+            # right away rather than when the next line replaces it
+            paper_bib_entries = _loads(line).get("bib_entries")
+            if not paper_bib_entries:
+                continue
+            # Extracts the bib_entities that the dataset uses (later papers' entries replace earlier ones)
+            bib_entries.update(
+                (bib_hash, bib_entry)
+                for bib_hash, bib_entry in paper_bib_entries.items()
+                if bib_hash in needed_bib_hashes
+            )
+    return bib_entries
+
+
 def main():
     argp = ArgumentParser()
     argp.add_argument(
@@ -200,8 +389,21 @@ def main():
         help="something in the out_xml_filtered directory. A dataset file that associates each table with some bib hashes",
     )
     argp.add_argument("out_path", type=str)
+    argp.add_argument(
+        "--num_processes", type=int, default=1, help="number of processes used to load the papers_path shards"
+    )
     args = argp.parse_args()
 
+    # First, find the bib entries that we need based on the dataset, so only those are kept when loading them
+    needed_bib_hashes = set()
+    all_arxiv_ids = set()
+    with open(args.dataset_path, "rb") as f:
+        for line in f:
+            sample = _loads(line)
+            needed_bib_hashes.update(sample["bib_hash"])
+            # also add the arxiv id for the paper
+            all_arxiv_ids.add(sample["paper_id"])
+
     all_bib_entries = {}
     print("Loading bib_entries from args.papers_path...")
     if os.path.isdir(args.papers_path):
@@ -209,36 +411,31 @@ def main():
     else:
         papers_paths = [args.papers_path]
 
-    for papers_path in tqdm(papers_paths):
-        valid_tables = []
-        if os.path.splitext(papers_path)[1] == ".gz":
-            f = gzip.open(papers_path, "r")
-        elif os.path.splitext(papers_path)[1] == ".jsonl":
-            f = open(papers_path)
-        else:
-            continue
-        # with open(args.papers_path) as f:
-        for line in f:
-            paper = json.loads(line)
-            # Extracts the bib_entities
-            all_bib_entries |= paper["bib_entries"]
-        f.close()
+    papers_paths = [
+        papers_path for papers_path in papers_paths if os.path.splitext(papers_path)[1] in {".gz", ".jsonl"}
+    ]
+    # later shards' entries replace earlier ones, as they did when merging all of them, so the shards are merged
+    # in order. `imap` keeps that order while the shards themselves are parsed in parallel
+    if args.num_processes > 1:
+        with multiprocessing.Pool(
+            args.num_processes, initializer=set_needed_bib_hashes, initargs=(needed_bib_hashes,)
+        ) as pool:
+            for shard_bib_entries in tqdm(pool.imap(load_bib_entries, papers_paths), total=len(papers_paths)):
+                all_bib_entries.update(shard_bib_entries)
+    else:
+        set_needed_bib_hashes(needed_bib_hashes)
+        for papers_path in tqdm(papers_paths):
+            all_bib_entries.update(load_bib_entries(papers_path))
     print("Done")
 
     # Subsets the ones that we need based on the dataset
-    all_bib_hashes = set()
-    all_arxiv_ids = set()
-    with open(args.dataset_path) as f:
-        for line in f:
-            sample = json.loads(line)
-            all_bib_hashes.update([bib_hash for bib_hash in sample["bib_hash"] if bib_hash in all_bib_entries])
-            # also add the arxiv id for the paper
-            all_arxiv_ids.add(sample["paper_id"])
+    all_bib_hashes = {bib_hash for bib_hash in needed_bib_hashes if bib_hash in all_bib_entries}
+    del needed_bib_hashes
 
     # Filters out the bib_hashes/arxiv_ids we've already saved
     if Path(args.out_path).exists():
-        with open(args.out_path) as f:
-            prev_bib_hash_dict = [json.loads(line) for line in f]
+        with open(args.out_path, "rb") as f:
+            prev_bib_hash_dict = [_loads(line) for line in f]
             prev_bib_hashes = set(entry["bib_hash_or_arxiv_id"] for entry in prev_bib_hash_dict)
         all_bib_hashes = [bib_hash for bib_hash in all_bib_hashes if bib_hash not in prev_bib_hashes]
         all_arxiv_ids = [arxiv_id for arxiv_id in all_arxiv_ids if arxiv_id not in prev_bib_hashes]
@@ -264,9 +461,8 @@ def main():
             )
         ]
 
-        with open(args.out_path, "a") as f:
-            for line in bib_hash_dict:
-                f.write(json.dumps(line) + "\n")
+        with open(args.out_path, "ab") as f:
+            f.write(b"".join(_dumps_line(line) for line in bib_hash_dict))
 
         time.sleep(1)  # for rate-limiting
 
@@ -276,12 +472,13 @@ def main():
         print(bib_hash_dict[0])
     print("Done!")
     print("Getting info for arxiv ids")
-    # # Next, do the arxiv ids
-    for i in trange(0, len(all_arxiv_ids), BATCH_SIZE):
-        arxiv_ids_batch = all_arxiv_ids[i : i + BATCH_SIZE]
+    # # Next, do the arxiv ids. These only need the public batch endpoint, so use the largest batches it allows
+    rate_limiter = RateLimiter(S2_REQUESTS_PER_SECOND)
+    for i in trange(0, len(all_arxiv_ids), S2_MAX_BATCH_SIZE):
+        arxiv_ids_batch = all_arxiv_ids[i : i + S2_MAX_BATCH_SIZE]
         # remove the versioning information
-        arxiv_ids_batch_stripped = [re.sub("v\d+", "", arxiv_id) for arxiv_id in arxiv_ids_batch]
-        metadata_batch = get_metadata_s2_public(arxiv_ids_batch_stripped, prefix="ARXIV:")
+        arxiv_ids_batch_stripped = [ARXIV_VERSION_RE.sub("", arxiv_id) for arxiv_id in arxiv_ids_batch]
+        metadata_batch = get_metadata_s2_public(arxiv_ids_batch_stripped, prefix="ARXIV:", rate_limiter=rate_limiter)
         # metadata_batch = get_metadata_local(arxiv_ids_batch_stripped, prefix="ARXIV:")
 
         # Kind of overloading this a bit... because we don't have bib_hashes for the ArXiv
@@ -297,58 +494,69 @@ def main():
             }
             for arxiv_id, metadata in zip(arxiv_ids_batch, metadata_batch)
         ]
-        with open(args.out_path, "a") as f:
-            for line in bib_hash_dict:
-                f.write(json.dumps(line) + "\n")
-
-        time.sleep(1)  # for rate-limiting
+        with open(args.out_path, "ab") as f:
+            f.write(b"".join(_dumps_line(line) for line in bib_hash_dict))
 
     # # Add the corpus ids to the dataset file
-    print("Editing the dataset file to add the corpus ids... Do not press CTRL-C")
+    print("Editing the dataset file to add the corpus ids...")
 
+    # the join only needs each entry's (corpus_id, title, abstract), so those are worked out once per entry here
+    # (rather than for every row that cites it), and the rest of the entry isn't kept
     print("Loading in saved bib_entries...")
-    with open(args.out_path) as f:
-        bib_hash_dict = [json.loads(line) for line in f]
-        bib_entry_map = {entry["bib_hash_or_arxiv_id"]: entry for entry in bib_hash_dict}
-
+    bib_entry_map = {}
+    with open(args.out_path, "rb") as f:
+        for line in f:
+            entry = _loads(line)
+            # the metadata is missing (None) or an error message (str) when we couldn't get it
+            metadata = entry.get("metadata")
+            if isinstance(metadata, dict):
+                bib_entry_map[entry["bib_hash_or_arxiv_id"]] = (
+                    entry["corpus_id"],
+                    metadata.get("title"),
+                    metadata.get("abstract"),
+                )
+            else:
+                bib_entry_map[entry["bib_hash_or_arxiv_id"]] = (entry["corpus_id"], None, None)
+
+    # the edited samples are streamed to a temporary file that then replaces the dataset, so the dataset isn't
+    # held in memory and an interrupted run leaves the original file as it was
     print("Adding corpus_ids, titles, and abstracts...")
-    new_dataset = []
+    tmp_dataset_path = args.dataset_path + ".tmp"
     missing_bibhash_or_arxiv_id = set()
-    with open(args.dataset_path) as f:
+    with open(args.dataset_path, "rb") as f, open(tmp_dataset_path, "wb") as out_f:
         for line in f:
-            sample = json.loads(line)
+            sample = _loads(line)
             for row in sample["row_bib_map"]:
                 if row["corpus_id"] != -1:
                     continue
-                try:
-                    row["corpus_id"] = bib_entry_map[row["bib_hash_or_arxiv_id"]]["corpus_id"]
-                except KeyError:
+                entry = bib_entry_map.get(row["bib_hash_or_arxiv_id"])
+                if entry is None:
                     missing_bibhash_or_arxiv_id.add(row["bib_hash_or_arxiv_id"])
                     continue
-                if bib_entry_map[row["bib_hash_or_arxiv_id"]].get("metadata") is None:
-                    row["title"] = None
-                    row["abstract"] = None
-                elif isinstance(bib_entry_map[row["bib_hash_or_arxiv_id"]]["metadata"], str):
-                    row["title"] = None
-                    row["abstract"] = None
-                else:
-                    row["title"] = bib_entry_map[row["bib_hash_or_arxiv_id"]]["metadata"].get("title")
-                    row["abstract"] = bib_entry_map[row["bib_hash_or_arxiv_id"]]["metadata"].get("abstract")
-            new_dataset.append(sample)
-
-    print("Saving new dataset to old path... Do not press CTRL-C")
-    with open(args.dataset_path, "w") as f:
-        for sample in new_dataset:
-            f.write(json.dumps(sample) + "\n")
+                row["corpus_id"], row["title"], row["abstract"] = entry
+            out_f.write(_dumps_line(sample))
+
+    print("Saving new dataset to old path...")
+    os.replace(tmp_dataset_path, args.dataset_path)
     print("... Done")
     print(len(missing_bibhash_or_arxiv_id))
     print(missing_bibhash_or_arxiv_id)
 
 
+FORMULA_RE = re.compile("{{formula.+?}}")
+WORD_RE = re.compile(r"\S+")
+WORD_PUNCT_RE = re.compile(r"^\W+|\W+$")
+
+
+def strip_word_punct(match):
+    return WORD_PUNCT_RE.sub("", match.group())
+
+
+@functools.lru_cache(maxsize=100_000)
 def normalize(text):
     # remove punctuation
-    text = re.sub("{{formula.+?}}", "", text)
-    text = re.sub("\S+", lambda m: re.sub("^\W+|\W+$", "", m.group()), text)
+    text = FORMULA_RE.sub("", text)
+    text = WORD_RE.sub(strip_word_punct, text)
     # remove surrounding quotes and spaces
     text = text.strip('"')
     text = text.strip()
@@ -356,58 +564,70 @@ def normalize(text):
     return text
 
 
-def get_corpus_ids_and_metadata_s2_public(titles_batch, verbose=False):
-    """Hits the elastic search api"""
+@functools.lru_cache(maxsize=100_000)
+def tokenize(text):
+    # the titles are already `normalize`d, which strips the punctuation from around each word, so splitting on
+    # whitespace gives the words without running nltk's tokenizer. The same titles are compared many times, so
+    # the tokens are cached (as tuples, so they can't be modified)
+    return tuple(text.split())
+
+
+def search_s2_public(title, rate_limiter=None, verbose=False):
+    """
+    Hits the elastic search api for a single title. Returns an (output, response) pair, where `output` is the
+    first search result whose title matches `title` (or None) and `response` is the full response.
+    Safe to call from multiple threads, as long as they share the `rate_limiter`.
+    """
+    if "{{formula}}" in title:
+        return None, None
+
     base_url = "https://api.semanticscholar.org/graph/v1/paper/search"
-    params = {"fields": "corpusId,externalIds,title,abstract", "limit": 5}
-    headers = {"x-api-key": S2_API_KEY}
+    params = {"fields": "corpusId,externalIds,title,abstract", "limit": 5, "query": title}
+    title_normalized = normalize(title)
+    # response = requests.get(base_url, params)
+    try:
+        response = request_s2("GET", base_url, rate_limiter, params=params, headers=S2_HEADERS)
+        response = response.json()
+    except (requests.RequestException, ValueError) as e:
+        # network errors and non-json responses are returned (like timeouts) rather than raised, so they don't stop
+        # the other searches and the title is searched for again on the next run
+        return None, {"request_error": {"type": type(e).__name__, "message": str(e)}}
+
+    if verbose:
+        print(response)
+    if response.get("data") is None or response.get("total") == 0:
+        return None, response
+
+    if verbose:
+        print(title_normalized)
+    for output in response.get("data"):
+        output_title_normalized = normalize(output["title"])
+        if verbose:
+            print(output_title_normalized)
+        if (
+            output_title_normalized in title
+            or title in output_title_normalized
+            or edit_distance(tokenize(output_title_normalized), tokenize(title_normalized)) < 4
+        ):
+            return output, response
+    return None, response
+
+
+def get_corpus_ids_and_metadata_s2_public(titles_batch, verbose=False):
+    """Hits the elastic search api for each of the titles in `titles_batch`"""
+    rate_limiter = RateLimiter(S2_REQUESTS_PER_SECOND)
     outputs = []
     responses = []
     for title in titles_batch:
-        if "{{formula}}" in title:
-            outputs.append(None)
-            responses.append(None)
-            continue
-
-        title_normalized = normalize(title)
-        params["query"] = title
-        # response = requests.get(base_url, params)
-        response = session.get(base_url, params, headers=headers)
-        response = response.json()
+        output, response = search_s2_public(title, rate_limiter, verbose=verbose)
+        outputs.append(output)
         responses.append(response)
-
-        if verbose:
-            print(response)
-        if response.get("data") is None or response.get("total") == 0:
-            outputs.append(None)
-            continue
-
-        if verbose:
-            print(title_normalized)
-        for output in response.get("data"):
-            output_title_normalized = normalize(output["title"])
-            if verbose:
-                print(output_title_normalized)
-            if (
-                output_title_normalized in title
-                or title in output_title_normalized
-                or edit_distance(word_tokenize(output_title_normalized), word_tokenize(title_normalized)) < 4
-            ):
-                outputs.append(output)
-                break
-        else:
-            outputs.append(None)
-        if len(titles_batch) > 1:
-            time.sleep(1)
     return outputs, responses
 
 
 def uniql(lst):
-    lst_uniq = []
-    for item in lst:
-        if item not in lst_uniq:
-            lst_uniq.append(item)
-    return lst_uniq
+    # dicts keep insertion order, so this dedups `lst` in linear time
+    return list(dict.fromkeys(lst))
 
 
 def main_2():
@@ -417,20 +637,16 @@ def main_2():
     can match based on any other heuristics at a later date.
     """
     print("Loading in our out_bib_entries file...", end="", flush=True)
-    with open("arxiv_dump/out_bib_entries.jsonl") as f:
-        out_bib_entries = [json.loads(line) for line in f]
+    with open("arxiv_dump/out_bib_entries.jsonl", "rb") as f:
+        out_bib_entries = [_loads(line) for line in f]
         out_bib_entries = {entry["bib_hash_or_arxiv_id"]: entry for entry in out_bib_entries}
     print("done.")
 
-    missing_corpus_ids = []
-    for bib_hash in out_bib_entries:
-        if out_bib_entries[bib_hash]["corpus_id"] == -1:
-            missing_corpus_ids.append(bib_hash)
-    missing_corpus_ids = uniql(missing_corpus_ids)
+    missing_corpus_ids = uniql(bib_hash for bib_hash, entry in out_bib_entries.items() if entry["corpus_id"] == -1)
 
     if os.path.exists("arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl"):
-        with open("arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl") as f:
-            all_outputs = [json.loads(line) for line in f]
+        with open("arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl", "rb") as f:
+            all_outputs = [_loads(line) for line in f]
             all_outputs = {resp["bib_hash"]: resp for resp in all_outputs}
     else:
         all_outputs = {}
@@ -440,8 +656,10 @@ def main_2():
     num_preprocessed_obtained = 0
     num_errors_or_timeouts = 0
     printed_previous_summary = False
-    unsaved_bib_hashes = []
-    for i, bib_hash in tqdm(enumerate(missing_corpus_ids), total=len(missing_corpus_ids)):
+
+    # first, work out which titles still need to be searched for
+    bib_hashes_to_search = []
+    for bib_hash in missing_corpus_ids:
         if out_bib_entries[bib_hash]["title"] is None:
             continue
 
@@ -461,54 +679,70 @@ def main_2():
             # we processed this bib_hash already, but already saved the output in out_bib_entries, so we should skip it
             continue
 
-        title = out_bib_entries[bib_hash]["title"]
-
-        outputs, responses = get_corpus_ids_and_metadata_s2_public([title], verbose=False)
-        # When there's a timeout, skip for now
-        if responses[0].get("message") in {"Internal Server Error", "Endpoint request timed out"}:
-            num_errors_or_timeouts += 1
-            if num_errors_or_timeouts % 100 == 0:
-                print(f"Skipped {num_errors_or_timeouts} so far.")
-            continue
-
-        all_responses[bib_hash] = responses[0]
-        all_responses[bib_hash]["bib_hash"] = bib_hash
+        bib_hashes_to_search.append(bib_hash)
 
-        if outputs[0] is not None:
-            all_outputs[bib_hash] = outputs[0]
-            all_outputs[bib_hash]["bib_hash"] = bib_hash
-
-            out_bib_entries[bib_hash]["corpus_id"] = outputs[0]["corpusId"]
-            out_bib_entries[bib_hash]["metadata"] = outputs[0]
-        else:
-            all_outputs[bib_hash] = {"bib_hash": bib_hash, "corpusId": -1}
-
-        unsaved_bib_hashes.append(bib_hash)
-        if len(unsaved_bib_hashes) >= 100:
-            print("Saving responses...", end="", flush=True)
-            for unsaved_bib_hash in unsaved_bib_hashes:
-                with open("arxiv_dump/out_bib_entries/s2_pub_search_responses.jsonl", "a") as f:
-                    f.write(json.dumps(all_responses[unsaved_bib_hash]) + "\n")
-                with open("arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl", "a") as f:
-                    f.write(json.dumps(all_outputs[unsaved_bib_hash]) + "\n")
-            print(" done")
-            unsaved_bib_hashes = []
-        time.sleep(1)
-
-    if len(unsaved_bib_hashes) >= 0:
+    def save_responses(bib_hashes):
         print("Saving responses...", end="", flush=True)
-        for unsaved_bib_hash in unsaved_bib_hashes:
-            with open("arxiv_dump/out_bib_entries/s2_pub_search_responses.jsonl", "a") as f:
-                f.write(json.dumps(all_responses[unsaved_bib_hash]) + "\n")
-            with open("arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl", "a") as f:
-                f.write(json.dumps(all_outputs[unsaved_bib_hash]) + "\n")
+        with open("arxiv_dump/out_bib_entries/s2_pub_search_responses.jsonl", "ab") as responses_f, open(
+            "arxiv_dump/out_bib_entries/s2_pub_search_selected.jsonl", "ab"
+        ) as selected_f:
+            # each file gets the whole batch in one write
+            responses_f.write(b"".join(_dumps_line(all_responses[bib_hash]) for bib_hash in bib_hashes))
+            selected_f.write(b"".join(_dumps_line(all_outputs[bib_hash]) for bib_hash in bib_hashes))
         print(" done")
 
+    # the searches run in a pool of threads (sharing one rate limiter), while the results are handled and saved
+    # here on the main thread as they come in
+    rate_limiter = RateLimiter(S2_REQUESTS_PER_SECOND)
+    unsaved_bib_hashes = []
+    executor = ThreadPoolExecutor(max_workers=NUM_SEARCH_WORKERS)
+    try:
+        futures = {
+            executor.submit(search_s2_public, out_bib_entries[bib_hash]["title"], rate_limiter): bib_hash
+            for bib_hash in bib_hashes_to_search
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            bib_hash = futures[future]
+            output, response = future.result()
+            if response is None:
+                # titles with formulas aren't searched for
+                response = {}
+
+            # When there's a timeout or the request failed, skip for now (it isn't saved, so it's retried next run)
+            if "request_error" in response or response.get("message") in {"Internal Server Error", "Endpoint request timed out"}:
+                num_errors_or_timeouts += 1
+                if num_errors_or_timeouts % 100 == 0:
+                    print(f"Skipped {num_errors_or_timeouts} so far.")
+                continue
+
+            all_responses[bib_hash] = response
+            all_responses[bib_hash]["bib_hash"] = bib_hash
+
+            if output is not None:
+                all_outputs[bib_hash] = output
+                all_outputs[bib_hash]["bib_hash"] = bib_hash
+
+                out_bib_entries[bib_hash]["corpus_id"] = output["corpusId"]
+                out_bib_entries[bib_hash]["metadata"] = output
+            else:
+                all_outputs[bib_hash] = {"bib_hash": bib_hash, "corpusId": -1}
+
+            unsaved_bib_hashes.append(bib_hash)
+            if len(unsaved_bib_hashes) >= SAVE_EVERY:
+                save_responses(unsaved_bib_hashes)
+                unsaved_bib_hashes = []
+    finally:
+        # if the run is aborted, drop the queued searches rather than waiting on them, and still save the
+        # results we already have
+        executor.shutdown(cancel_futures=True)
+        if unsaved_bib_hashes:
+            save_responses(unsaved_bib_hashes)
+
     print(f"Number of errors or timeouts: {num_errors_or_timeouts}. To get these, please re-run the script")
     os.rename("arxiv_dump/out_bib_entries.jsonl", "arxiv_dump/out_bib_entries/out_bib_entries.jsonl.bak6")
-    with open("arxiv_dump/out_bib_entries.jsonl", "w") as f:
+    with open("arxiv_dump/out_bib_entries.jsonl", "wb") as f:
         for key in out_bib_entries:
-            f.write(json.dumps(out_bib_entries[key]) + "\n")
+            f.write(_dumps_line(out_bib_entries[key]))
 
     if not printed_previous_summary:
         print(f"Skipped because we didn't find anything: {num_preprocessed_missing}")
@@ -522,8 +756,8 @@ def main_3():
     corpus ids for but no metadata (yet)
     """
     print("Loading in our out_bib_entries file...", end="", flush=True)
-    with open("arxiv_dump/out_bib_entries.jsonl") as f:
-        out_bib_entries = [json.loads(line) for line in f]
+    with open("arxiv_dump/out_bib_entries.jsonl", "rb") as f:
+        out_bib_entries = [_loads(line) for line in f]
         out_bib_entries = {entry["bib_hash_or_arxiv_id"]: entry for entry in out_bib_entries}
     print("done.")
 
@@ -540,9 +774,10 @@ def main_3():
 
 
     corpus_ids_missing_metadata_list = list(corpus_ids_missing_metadata.keys())
-    for i in trange(0, len(corpus_ids_missing_metadata_list), BATCH_SIZE):
-        corpus_ids_batch = corpus_ids_missing_metadata_list[i : i + BATCH_SIZE]
-        metadata_batch = get_metadata_s2_public(corpus_ids_batch)
+    rate_limiter = RateLimiter(S2_REQUESTS_PER_SECOND)
+    for i in trange(0, len(corpus_ids_missing_metadata_list), S2_MAX_BATCH_SIZE):
+        corpus_ids_batch = corpus_ids_missing_metadata_list[i : i + S2_MAX_BATCH_SIZE]
+        metadata_batch = get_metadata_s2_public(corpus_ids_batch, rate_limiter=rate_limiter)
 
         for corpus_id, metadata in zip(corpus_ids_batch, metadata_batch):
             for bib_hash in corpus_ids_missing_metadata[corpus_id]:
@@ -552,12 +787,11 @@ def main_3():
                     or "abstract" not in out_bib_entries[bib_hash]["metadata"]
                 ):
                     out_bib_entries[bib_hash]["metadata"] = metadata
-        time.sleep(1)
 
     print("Saving...")
-    with open("arxiv_dump/out_bib_entries.jsonl", "w") as f:
+    with open("arxiv_dump/out_bib_entries.jsonl", "wb") as f:
         for key in out_bib_entries:
-            f.write(json.dumps(out_bib_entries[key]) + "\n")
+            f.write(_dumps_line(out_bib_entries[key]))
     print("Done")
 
 
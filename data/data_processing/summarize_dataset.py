@@ -59,6 +59,19 @@ def print_summary(datas, names, sep=" "):
         )
 
 
+# compiled once here rather than on every call, since these run on every cell of every column
+NUMERIC_STRIP_RE = re.compile(r"[<$∼~∼\s]")
+# values that start with a number and a unit: thousands/millions, times, or frequencies
+UNITS_RE = re.compile(r"[<-]?\d+[km]|\d+(?:hrs?|hours?|ms?|mins?|minutes?|s|sec|seconds?|[gm]hz)")
+NA_STRIP_RE = re.compile(r"[∼~\s]")
+NA_VALUES = frozenset({"-", "–", "-", "n/a"})
+# matches the same values as `is_na`, so the n/a's of a whole table can be counted with pandas' vectorized
+# string matching
+NA_RE = re.compile(r"[∼~\s]*(?:[-–]|n[∼~\s]*/[∼~\s]*a)[∼~\s]*", re.IGNORECASE)
+BINARY_VALUES_LOWER = frozenset({"yes", "no"})
+BINARY_SYMBOLS = frozenset({"✘", "✗", "×", "✔", "✓"})
+
+
 def is_numeric(value):
     """
     Filters out values that contain some common numeric values that don't need context.
@@ -67,15 +80,8 @@ def is_numeric(value):
     so far from the high quality 2308 papers.
     """
     value = value.replace("below", "<")
-    value = re.sub(r"[<$∼~∼\s]", "", value.lower().strip())
-    units_regex = r"[<-]?\d+[km]"
-    time_regex = r"(\d+(?:hrs?|hours?))?(\d+(?:ms?|mins?|minutes?))?(\d+(?:s|sec|seconds?))?"
-    freq_regex = r"\d+[gm]hz"
-    if (
-        re.match(units_regex, value) is not None
-        or any(re.match(time_regex, value).groups())
-        or re.match(freq_regex, value) is not None
-    ):
+    value = NUMERIC_STRIP_RE.sub("", value.lower().strip())
+    if UNITS_RE.match(value) is not None:
         return True
     # this is dumb, but easy and fast
     try:
@@ -87,34 +93,38 @@ def is_numeric(value):
 
 def is_binary(value):
     value = value.strip()
-    return value.lower() in {"yes", "no"} or value in {"✘", "✗", "×", "✔", "✓"}
+    return value.lower() in BINARY_VALUES_LOWER or value in BINARY_SYMBOLS
 
 
 def is_na(value):
-    value = re.sub("[∼~\s]", "", value.lower())
-    return value in {"-", "–", "-", "n/a"}
+    value = NA_STRIP_RE.sub("", value.lower())
+    return value in NA_VALUES
 
 
 def get_aspect_type(column):
     if "{{cite:" in column[0]:
         return "cite"
 
-    if all([is_numeric(val) or is_na(val) for val in column]):
+    # every check below skips the n/a values, so find them once up front. The `all`s stop at the first
+    # value that doesn't fit
+    na_vals = [is_na(val) for val in column]
+    if all(val_is_na or is_numeric(val) for val, val_is_na in zip(column, na_vals)):
         return "num"
 
-    if all([is_binary(val) or is_na(val) for val in column]):
+    if all(val_is_na or is_binary(val) for val, val_is_na in zip(column, na_vals)):
         return "bool"
 
-    if len(set(column)) == 1:
+    num_uniq_vals = len(set(column))
+    if num_uniq_vals == 1:
         # meant for grouping
         return "cat-uniq"
 
-    if len(set(column)) != len(column):
+    if num_uniq_vals != len(column):
         # meant for grouping
         return "cat"
 
     # use length as a heuristic to determine if its gen or ent
-    val_lens = [len(val.split()) > 4 for val in column if not is_na(val)]
+    val_lens = [len(val.split()) > 4 for val, val_is_na in zip(column, na_vals) if not val_is_na]
     if sum(val_lens) > len(val_lens) / 2:
         return "gen"
     else:
@@ -133,49 +143,67 @@ def main_tables():
 
     # 0. Print size of dataset
     print(f"Number of instances: {len(dataset)}\n")
-    # 1. Compute number of rows, columns, and unique rows for the dataset
 
-    tables_df = [pd.DataFrame(tab['table']) for tab in dataset]
-    tables_df = [tab.map(lambda x: x[0]) for tab in tables_df]
+    # the table values are single-item lists, so unwrap them while building the DataFrames rather than
+    # mapping over every cell afterwards
+    tables_df = [
+        pd.DataFrame({col: {row: cell[0] for row, cell in col_vals.items()} for col, col_vals in tab["table"].items()})
+        for tab in dataset
+    ]
 
     print(tables_df[0])
-    separator = " & " if args.latex else "  "
-    print_summary(
-        [
-            [tab.shape[0] for tab in tables_df],
-            [len(set(tab.index.tolist())) for tab in tables_df],
-            [tab.shape[1] for tab in tables_df],
-        ],
-        ["Papers", "Papers (uniq)", "Aspects"],
-        sep=separator,
-    )
-    print()
 
-    # 2. Compute how many unique papers are considered by the tables using corpus ids
+    # a single pass over the tables collects all of the stats summarized below
+    num_rows = []
+    num_uniq_rows = []
+    num_cols = []
     unique_corpus_ids = set()
     missing_corpus_ids = 0
+    table_aspect_labels = {}
+    all_aspect_labels = []
+    num_nas_total = 0
+    num_values_total = 0
+    num_vague_columns = 0
     for table, table_df in zip(dataset, tables_df):
-        new_row_bib_map = [sample for sample in table["row_bib_map"] if f'{sample["corpus_id"]}' in table_df.index]
-        for row in new_row_bib_map:
+        index = set(table_df.index.tolist())
+        num_rows.append(table_df.shape[0])
+        num_uniq_rows.append(len(index))
+        num_cols.append(table_df.shape[1])
+
+        # papers considered by the table, using corpus ids
+        for row in table["row_bib_map"]:
+            if f'{row["corpus_id"]}' not in index:
+                continue
             if row["corpus_id"] == -1:
                 missing_corpus_ids += 1
                 continue
             unique_corpus_ids.add(row["corpus_id"])
-    print(f"Number of unique corpus ids among all tables: {len(unique_corpus_ids)}")
-    print(f"Number of papers missing corpus ids: {missing_corpus_ids}")
-    print()
 
-    # 3. Compute the distribution of aspect types
-    table_aspect_labels = {}
-    all_aspect_labels = []
-    for table, table_df in zip(dataset, tables_df):
-        # tab_dict = table["table_json"]["table_dict"]
-        aspect_labels = []
-        for col in table_df:
-            aspect_labels.append(get_aspect_type(table_df[col].tolist()))
+        aspect_labels = [get_aspect_type(table_df[col].tolist()) for col in table_df]
         table_aspect_labels[table["tabid"]] = aspect_labels
         all_aspect_labels.extend(aspect_labels)
 
+        table_values = pd.Series(table_df.to_numpy().ravel(), dtype=object)
+        num_nas_total += int(table_values.str.fullmatch(NA_RE).sum())
+        num_values_total += table_values.size
+
+        num_vague_columns += sum(is_column_vague(col) for col in table_df.columns)
+
+    # 1. Number of rows, columns, and unique rows
+    separator = " & " if args.latex else "  "
+    print_summary(
+        [num_rows, num_uniq_rows, num_cols],
+        ["Papers", "Papers (uniq)", "Aspects"],
+        sep=separator,
+    )
+    print()
+
+    # 2. How many unique papers are considered by the tables
+    print(f"Number of unique corpus ids among all tables: {len(unique_corpus_ids)}")
+    print(f"Number of papers missing corpus ids: {missing_corpus_ids}")
+    print()
+
+    # 3. The distribution of aspect types
     print("Distribution of types of aspects:")
     label_dist = Counter(all_aspect_labels)
     del label_dist["cite"]
@@ -190,24 +218,14 @@ def main_tables():
         )
 
     print("\nNumber of n/a's:")
-    num_nas_total = 0
-    num_values_total = 0
-    for table_df in tables_df:
-        num_values_total += sum([table_df.shape[0] * table_df.shape[1]])
-        num_nas_total += sum([len([v for v in val if is_na(v)]) for val in table_df.values])
     print(f"{num_nas_total} / {num_values_total} ({num_nas_total/num_values_total:.3%})")
 
 
     print("\nNumber of vague columns:")
-    num_total_columns = 0
-    num_vague_columns = 0
-    for table_df in tables_df:
-        num_total_columns += table_df.shape[1]
-        num_vague_columns += sum([is_column_vague(col) for col in table_df.columns])
+    num_total_columns = sum(num_cols)
     print(f"{num_vague_columns} / {num_total_columns} ({num_vague_columns / num_total_columns:.3%})")
 
 
 
-
 if __name__ == "__main__":
     main_tables()
@@ -1,3 +1,4 @@
+import threading
 from typing import Any, Optional
 
 # from bert_score import BERTScorer
@@ -120,6 +121,8 @@ class SchemaRecallMetric(BaseMetric):
         self.scores["recall"] = {}
         self.scores["alignment_scores"] = {}
         self.scores["alignments"] = {}
+        # `add` can be called from several threads. The scoring runs concurrently, but storing the scores doesn't
+        self.lock = threading.Lock()
 
     def add(self, prediction: Table, target: Table, metadata: Optional[Any] = None, return_scores: bool = False):
         # compute alignment matrix between the prediction and target tables
@@ -151,14 +154,15 @@ class SchemaRecallMetric(BaseMetric):
 
         # store recall score, alignment matrix and final alignments
         # TODO: Maybe some of these variables can be dropped?
-        if not target.tabid in self.scores["recall"]:
-            self.scores["recall"][target.tabid] = []
-            self.scores["alignment_scores"][target.tabid] = []
-            self.scores["alignments"][target.tabid] = []
-
-        self.scores["recall"][target.tabid].append(recall)
-        self.scores["alignment_scores"][target.tabid].append(alignment_matrix)
-        self.scores["alignments"][target.tabid].append(alignment)
+        with self.lock:
+            if not target.tabid in self.scores["recall"]:
+                self.scores["recall"][target.tabid] = []
+                self.scores["alignment_scores"][target.tabid] = []
+                self.scores["alignments"][target.tabid] = []
+
+            self.scores["recall"][target.tabid].append(recall)
+            self.scores["alignment_scores"][target.tabid].append(alignment_matrix)
+            self.scores["alignments"][target.tabid].append(alignment)
 
         if return_scores:
             return recall, alignment_matrix, alignment
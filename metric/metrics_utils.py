@@ -1,27 +1,57 @@
 """Utility functions for computing metrics"""
 
+import asyncio
 import difflib
+import functools
+import hashlib
 import json
 import os
+import random
 import re
+import threading
 import time
 from typing import Any
 
+import diskcache
 import numpy as np
 import pandas as pd
 import torch
 from nltk import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer, util
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+
+try:
+    # the normalized indel (LCS-based) similarity in C++, rather than difflib's pure python matching
+    from rapidfuzz.distance.Indel import normalized_similarity as edit_similarity
+except ImportError:
+    edit_similarity = None
+from sentence_transformers import SentenceTransformer
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from table import Table
 
 stopwords = stopwords.words("english")
-punctuation = "()[]{},.?!/''\"``"
 ps = PorterStemmer()
+# every word is checked against the stopwords, so look them up in a set
+STOPWORDS = frozenset(stopwords)
+# column names are short, so a regex finds their words much faster than nltk's word_tokenize
+TOKEN_RE = re.compile(r"\w+")
+
+
+@functools.lru_cache(maxsize=100_000)
+def stem(word: str) -> str:
+    return ps.stem(word)
+
+
+@functools.lru_cache(maxsize=100_000)
+def get_keywords(sentence: str) -> frozenset[str]:
+    """Extract the lowercased and stemmed non-stopword words of `sentence`. The same columns are compared with
+    every column of the other table, so the keywords are cached (as frozensets, so they can't be modified).
+    """
+    return frozenset(
+        stem(word) for word in (word.lower() for word in TOKEN_RE.findall(sentence)) if word not in STOPWORDS
+    )
 
 # Moving to Together AI API to query mistral for decontextualization
 TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
@@ -29,10 +59,34 @@ TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# the most decontextualization requests sent to the Together API at once
+MAX_CONCURRENT_QUERIES = 16
+# where the decontextualization responses are cached across runs
+DECONTEXT_CACHE_DIR = ".decontext_cache"
+# failed API queries are retried with exponential backoff, up to MAX_RETRIES times
+MAX_RETRIES = 5
+MAX_BACKOFF = 32  # seconds
+
 pd.set_option("display.max_colwidth", None)
 pd.set_option("display.max_columns", None)
 
 
+def get_backoff_delay(attempt: int) -> float:
+    """Return how long to wait before retrying a query that has failed `attempt` + 1 times: 1, 2, 4, ... seconds
+    (capped at MAX_BACKOFF), plus up to a second of jitter so concurrent queries don't all retry at once.
+    """
+    return min(2**attempt + random.random(), MAX_BACKOFF)
+
+
+def get_table_dataframe(table: Table) -> pd.DataFrame:
+    """Return `table`'s values as a DataFrame. It's built the first time and stored on the table, since the same
+    (gold) tables are featurized many times over an eval run.
+    """
+    if table.dataframe is None:
+        table.dataframe = pd.DataFrame(table.values)
+    return table.dataframe
+
+
 class BaseFeaturizer:
     """Given a list of columns, create featurized strings for every column, for better matching/alignment.
 
@@ -80,13 +134,10 @@ class ValueFeaturizer(BaseFeaturizer):
         """Return featurized strings containing column values"""
         featurized_columns = []
         for column in column_names:
-            value_list = []
-            for value in list(table.values[column].values()):
-                if isinstance(value, list):
-                    value_list += [str(x) for x in value]
-                else:
-                    value_list.append(str(value))
-            column_values = ", ".join(value_list)
+            # the values are usually single-item lists, which are flattened into the other values
+            column_values = ", ".join(
+                [str(x) for value in table.values[column].values() for x in (value if isinstance(value, list) else (value,))]
+            )
             featurized_columns.append(f"Column named {column} has values: {column_values}")
         return featurized_columns
 
@@ -100,10 +151,31 @@ class DecontextFeaturizer(BaseFeaturizer):
     name: str
     metadata: dict
 
-    def __init__(self, name, model="mistralai/Mistral-7B-Instruct-v0.2"):
+    def __init__(
+        self,
+        name,
+        model="mistralai/Mistral-7B-Instruct-v0.2",
+        max_concurrency=MAX_CONCURRENT_QUERIES,
+        cache_dir=DECONTEXT_CACHE_DIR,
+        skip_column_names=None,
+    ):
         super().__init__(name)
         self.metadata["model_name"] = model
+        self.metadata["max_concurrency"] = max_concurrency
+        # columns with these names (compared case-insensitively) aren't decontextualized, and keep their name as-is.
+        # Meant for vague headers (e.g. "Year") that there's little to say about
+        self.metadata["skip_column_names"] = frozenset(name.strip().lower() for name in skip_column_names or ())
+        # the same columns (e.g. "Year") come up in many tables, so responses are cached on disk by model and prompt
+        self.cache = diskcache.Cache(cache_dir)
         self.load_model_and_tokenizer(model)
+        # the async client's connections belong to the event loop they were opened on, so every call to `featurize`
+        # runs on this same loop to reuse them
+        self.loop = asyncio.new_event_loop()
+        # prompt -> response, for every prompt queried so far (including the ones from `prefetch`)
+        self.responses = {}
+        # number of (decontextualized) columns that `featurize` left as their raw name because their query failed
+        self.num_fallback_columns = 0
+        self.lock = threading.Lock()
 
     def load_model_and_tokenizer(self, model_name: str):
         """Given a model name, start a together client to query that model.
@@ -111,7 +183,7 @@ class DecontextFeaturizer(BaseFeaturizer):
         Args:
            model_name (str): Name of model to query
         """
-        self.metadata["model"] = OpenAI(
+        self.metadata["model"] = AsyncOpenAI(
             api_key=TOGETHER_API_KEY,
             base_url="https://api.together.xyz/v1",
         )
@@ -125,28 +197,32 @@ class DecontextFeaturizer(BaseFeaturizer):
         # self.metadata["model"] = mistral_model
         # self.metadata["tokenizer"] = mistral_tokenizer
 
-    def query_model(self, prompt):
-        """Run model inference on provided prompt.
+    async def query_model(self, prompt):
+        """Run model inference on provided prompt. Rate limits, connection errors (including timeouts) and server
+        errors are retried with exponential backoff; any other error is raised right away.
 
         Args:
             prompt (str): Prompt to query model with.
         """
         # generated_ids = []
         # inputs = self.metadata['tokenizer'].apply_chat_template(prompt, return_tensors="pt").to(DEVICE)
-        try:
-            chat_completion = self.metadata["model"].chat.completions.create(
-                messages=prompt,
-                model=self.metadata["model_name"],
-                max_tokens=256,
-                temperature=0.7,
-                top_p=0.7,
-            )
-            response = chat_completion.choices[0].message.content
-            # generated_ids = self.metadata['model'].generate(inputs, max_new_tokens=100, do_sample=True, num_return_sequences=1)
-        except Exception as e:
-            print(e)
-            time.sleep(10)
-            return self.query_model(prompt)
+        for attempt in range(MAX_RETRIES):
+            try:
+                chat_completion = await self.metadata["model"].chat.completions.create(
+                    messages=prompt,
+                    model=self.metadata["model_name"],
+                    max_tokens=256,
+                    temperature=0.7,
+                    top_p=0.7,
+                )
+                response = chat_completion.choices[0].message.content
+                # generated_ids = self.metadata['model'].generate(inputs, max_new_tokens=100, do_sample=True, num_return_sequences=1)
+                break
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                print(e)
+                await asyncio.sleep(get_backoff_delay(attempt))
         #     response = self.metadata['tokenizer'].batch_decode(generated_ids[:, inputs.shape[1] :], skip_special_tokens=True)
         # except torch.cuda.OutOfMemoryError:
         #     # for debugging
@@ -160,6 +236,36 @@ class DecontextFeaturizer(BaseFeaturizer):
 
         return response
 
+    async def query_model_batch(self, prompts):
+        """Run model inference on all of the provided prompts concurrently (at most `max_concurrency` at a time).
+        Each response is stored in `self.responses` and cached on disk as soon as it arrives, so a later failure
+        doesn't lose it. A prompt that still hits a rate limit, connection or server error after its retries gets a
+        response of None (and isn't stored). Any other error is raised once all of the queries have finished.
+
+        Args:
+            prompts (list[str]): Prompts to query model with.
+        """
+        semaphore = asyncio.Semaphore(self.metadata["max_concurrency"])
+
+        async def query(prompt):
+            async with semaphore:
+                try:
+                    response = await self.query_model([{"role": "user", "content": prompt}])
+                except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                    # failed queries aren't stored (or cached), so they're retried the next time they're needed
+                    print(f"Query failed: {e!r}")
+                    return None
+            self.responses[prompt] = response
+            self.cache.set(self.get_cache_key(prompt), response)
+            return response
+
+        # wait for every query (so none are left pending on the loop) before raising the first error
+        responses = await asyncio.gather(*[query(prompt) for prompt in prompts], return_exceptions=True)
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        return responses
+
     def create_column_decontext_prompts(self, column_names: list[str], table: pd.DataFrame) -> list[str]:
         """Construct a list of prompts to decontextualize all column names present in the table.
 
@@ -168,16 +274,75 @@ class DecontextFeaturizer(BaseFeaturizer):
             table (pd.DataFrame): Source table to provide additional context (in dataframe format).
         """
         decontext_prompts = []
+        if not column_names:
+            return decontext_prompts
+        # every column's prompt has the same table, so it's only rendered once
+        table_markdown = table.to_markdown()
         for column in column_names:
             # cur_table = table[[column]]
             instruction = f"""\
                 In the context of the following table from a scientific paper, what does {column} refer to? Answer in a single sentence. If the answer is not clear just write 'unanswerable'.
                 Table:
-                {table.to_markdown()}\
+                {table_markdown}\
             """
             decontext_prompts.append(instruction)
         return decontext_prompts
 
+    def get_cache_key(self, prompt: str) -> str:
+        """Return the key of the cached response to `prompt` from this featurizer's model."""
+        return hashlib.sha256(f"{self.metadata['model_name']}\x00{prompt}".encode()).hexdigest()
+
+    def query_missing(self, prompts: list[str]):
+        """Query the model (concurrently) for each of the `prompts` that doesn't have a response yet.
+
+        Args:
+            prompts (list[str]): Prompts to get responses for. The responses are stored in `self.responses`, and
+                cached on disk. Prompts whose query fails with a transient error are left out.
+        """
+        # `featurize` can be called from several threads, which can't run the event loop at the same time
+        with self.lock:
+            missing_prompts = []
+            for prompt in dict.fromkeys(prompts):
+                if prompt in self.responses:
+                    continue
+                response = self.cache.get(self.get_cache_key(prompt))
+                if response is not None:
+                    self.responses[prompt] = response
+                else:
+                    missing_prompts.append(prompt)
+            if not missing_prompts:
+                return
+
+            self.loop.run_until_complete(self.query_model_batch(missing_prompts))
+
+    def prefetch(self, tables: list[Table]):
+        """Decontextualize the columns of all of the `tables` up front, so the queries for a whole eval run
+        overlap rather than being sent a table at a time. Later calls to `featurize` use the stored responses.
+
+        Raises a RuntimeError if any of the columns couldn't be decontextualized, rather than letting them fall back
+        to their raw names (and scoring the run on a mix of featurizations).
+
+        Args:
+            tables (list[Table]): Tables that will be featurized.
+        """
+        prompts = []
+        for table in tables:
+            if table.decontext_schema is None:
+                decontext_columns = self.get_decontext_columns(list(table.schema))
+                prompts.extend(self.create_column_decontext_prompts(decontext_columns, get_table_dataframe(table)))
+        self.query_missing(prompts)
+        num_failed = sum(prompt not in self.responses for prompt in dict.fromkeys(prompts))
+        if num_failed:
+            raise RuntimeError(
+                f"Failed to decontextualize {num_failed} columns. "
+                "The other responses are cached, so re-run to retry them."
+            )
+
+    def get_decontext_columns(self, column_names: list[str]) -> list[str]:
+        """Return the columns in `column_names` that should be decontextualized (i.e. aren't skipped)."""
+        skip_column_names = self.metadata["skip_column_names"]
+        return [column for column in column_names if column.strip().lower() not in skip_column_names]
+
     # TODO: Can we skip filtering out of numeric/binary values now that we aren't decontextualizing values?
     # TODO: Based on prior discussions, I'm not using paper title/abstract/section text/caption during decontextualization,
     # since we may not accurately get this information for predicted tables. We can revisit this after seeing what scores look like?
@@ -188,20 +353,23 @@ class DecontextFeaturizer(BaseFeaturizer):
         # return the cached descriptions instead of regenerating
         if table.decontext_schema is not None:
             return [table.decontext_schema[x] for x in column_names]
-        featurized_columns = []
-        table_df = pd.DataFrame(table.values)
-        column_decontext_prompts = self.create_column_decontext_prompts(column_names, table_df)
-        for i, prompt in enumerate(column_decontext_prompts):
-            full_prompt = [{"role": "user", "content": prompt}]
-            try:
-                response = self.query_model(full_prompt)
-            except torch.cuda.OutOfMemoryError:
-                # If prompt doesn't fit in memory, just return column name
-                print("OOM num chars:", len(prompt))
-                response = [column_names[i]]
-            featurized_columns.append(response.strip())
-            # featurized_columns.append(response[0])
-        return featurized_columns
+        table_df = get_table_dataframe(table)
+        decontext_columns = self.get_decontext_columns(column_names)
+        column_decontext_prompts = self.create_column_decontext_prompts(decontext_columns, table_df)
+        # the columns' prompts are sent all at once, so their requests overlap rather than waiting on each other
+        self.query_missing(column_decontext_prompts)
+        # columns whose query failed keep their raw names, like the skipped columns (and are counted)
+        decontext_descriptions = {
+            column: self.responses[prompt].strip()
+            for column, prompt in zip(decontext_columns, column_decontext_prompts)
+            if prompt in self.responses
+        }
+        num_fallback_columns = sum(prompt not in self.responses for prompt in column_decontext_prompts)
+        if num_fallback_columns:
+            print(f"Failed to decontextualize {num_fallback_columns} columns of {table.tabid}; using their names.")
+            with self.lock:
+                self.num_fallback_columns += num_fallback_columns
+        return [decontext_descriptions.get(column, column) for column in column_names]
 
 
 class BaseAlignmentScorer:
@@ -235,6 +403,12 @@ class BaseAlignmentScorer:
 
         raise NotImplementedError()
 
+    def is_exact_match(self, prediction: str, target: str) -> bool:
+        """Check whether the strings match (ignoring case and surrounding whitespace). Scorers treat these as
+        perfect matches without computing their similarity.
+        """
+        return prediction is target or prediction.strip().lower() == target.strip().lower()
+
     # Function to compute alignment scores for all column pairs, given a pair of tables
     def score_schema_alignments(
         self, pred_table: Table, gold_table: Table, featurizer=BaseFeaturizer("name")
@@ -246,7 +420,6 @@ class BaseAlignmentScorer:
            gold_table (Table): The gold table.
            featurizer (Featurizer): Featurization strategy to be applied to columns (default simply uses column names)
         """
-        alignment_matrix = {}
         pred_col_list = list(pred_table.schema)
         gold_col_list = list(gold_table.schema)
 
@@ -258,17 +431,32 @@ class BaseAlignmentScorer:
         # to improve efficiency, calculate_pair_similarity operates in batch mode (on lists of strings).
         # So alignment matrix construction differs slightly for both categories.
         if self.name not in ["sentence_transformer"]:
-            for i, gold_col_name in enumerate(featurized_gold_col_list):
-                for j, pred_col_name in enumerate(featurized_pred_col_list):
-                    pair_score = self.calculate_pair_similarity(pred_col_name, gold_col_name)
-                    alignment_matrix[(gold_col_list[i], pred_col_list[j])] = pair_score
+            # several columns can have the same featurized string (e.g. with vague headers), so each unique pair of
+            # strings is only scored once. Identical strings are a perfect match for every scorer, so they skip the
+            # similarity calculation
+            calculate_pair_similarity = self.calculate_pair_similarity
+            pair_scores = {
+                (gold_col_name, pred_col_name): (
+                    1.0 if pred_col_name == gold_col_name else calculate_pair_similarity(pred_col_name, gold_col_name)
+                )
+                for gold_col_name in dict.fromkeys(featurized_gold_col_list)
+                for pred_col_name in dict.fromkeys(featurized_pred_col_list)
+            }
+            alignment_matrix = {
+                (gold_col, pred_col): pair_scores[(gold_col_name, pred_col_name)]
+                for gold_col, gold_col_name in zip(gold_col_list, featurized_gold_col_list)
+                for pred_col, pred_col_name in zip(pred_col_list, featurized_pred_col_list)
+            }
         else:
             # Instead of computing similarity for every column pair separately, the computation is batched.
             # This ensures that encoding is performed only once instead of being recomputed per comparison.
-            sim_matrix = self.calculate_pair_similarity(featurized_pred_col_list, featurized_gold_col_list)
-            for i, gold_col_name in enumerate(featurized_gold_col_list):
-                for j, pred_col_name in enumerate(featurized_pred_col_list):
-                    alignment_matrix[(gold_col_list[i], pred_col_list[j])] = sim_matrix[j][i]
+            # The [n_pred, n_gold] matrix is converted to python floats all at once
+            sim_matrix = self.calculate_pair_similarity(featurized_pred_col_list, featurized_gold_col_list).tolist()
+            alignment_matrix = {
+                (gold_col, pred_col): sim_matrix[j][i]
+                for i, gold_col in enumerate(gold_col_list)
+                for j, pred_col in enumerate(pred_col_list)
+            }
 
         return alignment_matrix
     
@@ -289,17 +477,19 @@ class BaseAlignmentScorer:
         # Iterate over the matched column names 
         # For each column name, compute alignment scores per pair of rows
         pair_index = 0
-        for i, gold_col_name in enumerate(gold_col_list):
-            for j, corpus_id in enumerate(gold_table.values[gold_col_name]):
+        for gold_col_name in gold_col_list:
+            # each column's values are looked up once, rather than for every row
+            gold_col_values = gold_table.values[gold_col_name]
+            pred_col_values = pred_table.values.get(gold_col_name, {})
+            for corpus_id, gold_values in gold_col_values.items():
                 pair_index += 1
-                gold_value = gold_table.values[gold_col_name][corpus_id][0]
-                if not gold_col_name in pred_table.values or not corpus_id in pred_table.values[gold_col_name]:
+                if corpus_id not in pred_col_values:
                     alignment_matrix[(gold_col_name, corpus_id)] = 0.0
                     continue
-                if pred_table.values[gold_col_name][corpus_id] == "N/A":
+                pred_value = pred_col_values[corpus_id]
+                if pred_value == "N/A":
                     continue
-                pred_value = pred_table.values[gold_col_name][corpus_id]
-                pair_score = self.calculate_pair_similarity(pred_value, gold_value)
+                pair_score = self.calculate_pair_similarity(pred_value, gold_values[0])
                 # Set a counter/ID as the first element of the key in alignment matrix
                 # since this element will be used as a unique ID when aggregating for recall
                 alignment_matrix[(pair_index, gold_col_name, corpus_id)] = pair_score
@@ -315,7 +505,7 @@ class ExactMatchScorer(BaseAlignmentScorer):
 
     def calculate_pair_similarity(self, prediction: str, target: str) -> float:
         """Similarity calculation based on exact string match."""
-        if prediction.lower() == target.lower():
+        if self.is_exact_match(prediction, target):
             return 1.0
         return 0.0
 
@@ -328,8 +518,12 @@ class EditDistanceScorer(BaseAlignmentScorer):
 
     def calculate_pair_similarity(self, prediction: str, target: str) -> float:
         """Similarity calculation based on edit distance.
-        We compute the edit distance between two strings using difflib.
+        We compute the edit distance between two strings using rapidfuzz (or difflib, if it's not installed).
         """
+        if self.is_exact_match(prediction, target):
+            return 1.0
+        if edit_similarity is not None:
+            return float(edit_similarity(prediction.lower(), target.lower()))
         matcher = difflib.SequenceMatcher(None, prediction.lower(), target.lower())
         return float(matcher.ratio())
 
@@ -350,7 +544,7 @@ class JaccardAlignmentScorer(BaseAlignmentScorer):
         """Extract non-stopword keywords from a sentence.
 
         Extract keywords from a sentence by lowercasing, tokenizing and stemming words. Punctuation and
-        stopwords ar filtered out. Only unique words are returned.
+        stopwords are filtered out. Only unique words are returned.
 
         Args:
             sentence (str): The text to extract keywords from.
@@ -358,13 +552,7 @@ class JaccardAlignmentScorer(BaseAlignmentScorer):
         Returns:
             set[str] containing the keywords in the sentence.
         """
-        return set(
-            [
-                ps.stem(word.lower())
-                for word in word_tokenize(sentence)
-                if word not in stopwords and word not in punctuation
-            ]
-        )
+        return get_keywords(sentence)
 
     def jaccard(self, a: set[Any], b: set[Any]) -> float:
         """Calculate and return the Jaccard similarity between set `a` and `b`."""
@@ -373,6 +561,8 @@ class JaccardAlignmentScorer(BaseAlignmentScorer):
 
     def calculate_pair_similarity(self, prediction: str, target: str) -> float:
         """Similarity calculation based on jaccard overlap between tokens."""
+        if self.is_exact_match(prediction, target):
+            return 1.0
         prediction_words, target_words = [], []
         if self.metadata["remove_stopwords"]:
             prediction_words = self.get_keywords(prediction)
@@ -397,14 +587,51 @@ class SentenceTransformerAlignmentScorer(BaseAlignmentScorer):
         """We can choose which sentence transformer model to use while initializing."""
         super().__init__("sentence_transformer")
         self.metadata["model"] = model
-        self.model = SentenceTransformer(model)
+        self.model = SentenceTransformer(model, device=DEVICE)
+        if DEVICE == "cuda":
+            # half precision roughly doubles the encoding throughput on gpus, and barely changes the similarities
+            self.model.half()
+        # text -> normalized embedding. Column names (and gold tables) repeat across the tables being evaluated,
+        # so each string is only encoded once
+        self.embedding_cache = {}
+
+    def encode(self, texts: list[str], batch_size: int = 32, show_progress_bar: bool = False) -> np.ndarray:
+        """Return the normalized embeddings of `texts` (one row per text), encoding only the uncached ones.
+        Encoding all of a run's texts up front (with a large `batch_size`) makes later calls cache lookups.
+        """
+        missing_texts = [text for text in dict.fromkeys(texts) if text not in self.embedding_cache]
+        if missing_texts:
+            embeddings = self.model.encode(
+                missing_texts,
+                batch_size=batch_size,
+                show_progress_bar=show_progress_bar,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+            # the cached embeddings (and the similarity matmul) stay in float32, even when the model is half precision
+            self.embedding_cache.update(zip(missing_texts, embeddings.astype(np.float32, copy=False)))
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack([self.embedding_cache[text] for text in texts])
 
     # For better efficiency, the pair similarity calculation function takes batches of strings
     def calculate_pair_similarity(self, predictions: list[str], targets: list[str]) -> float:
-        """Similarity calculation based on jaccard overlap between tokens."""
-        pred_embeds = self.model.encode(predictions)
-        gold_embeds = self.model.encode(targets)
-        sim_mat_cosine = util.cos_sim(pred_embeds, gold_embeds).numpy()
+        """Similarity calculation based on cosine similarity between sentence embeddings. Returns the matrix of
+        similarities between lists of strings, or a single score for a pair of strings (e.g. values).
+        """
+        if isinstance(predictions, str) and isinstance(targets, str):
+            return float(self.calculate_pair_similarity([predictions], [targets])[0, 0])
+        pred_embeds = self.encode(predictions)
+        gold_embeds = self.encode(targets)
+        # the embeddings are normalized, so their dot products are the cosine similarities
+        sim_mat_cosine = pred_embeds @ gold_embeds.T
+        # exact matches are perfect matches, as with the other scorers
+        target_indices = {}
+        for i, target in enumerate(targets):
+            target_indices.setdefault(target.strip().lower(), []).append(i)
+        for j, prediction in enumerate(predictions):
+            for i in target_indices.get(prediction.strip().lower(), ()):
+                sim_mat_cosine[j, i] = 1.0
         return sim_mat_cosine
 
 
@@ -432,9 +659,27 @@ def get_p_r_f1(tp: int, fp: int, fn: int) -> tuple[float, float, float]:
         return p, r, 2 * p * r / (p + r)
 
 
+JSON_DECODER = json.JSONDecoder()
+
+
+def extract_json_list(text: str) -> list:
+    """Return the first JSON list in `text` (e.g. a model response with some prose around the list).
+
+    Each "[" is tried as the start of the list in turn, and parsing stops at the end of the list, so (unlike a
+    greedy regex) long or malformed responses don't backtrack. Raises a `json.JSONDecodeError` if there's no list.
+    """
+    start = text.find("[")
+    while start != -1:
+        try:
+            return JSON_DECODER.raw_decode(text, start)[0]
+        except json.JSONDecodeError:
+            start = text.find("[", start + 1)
+    raise json.JSONDecodeError("No JSON list found", text, 0)
+
+
 class Llama3AlignmentScorer(BaseAlignmentScorer):
 
-    def __init__(self, name="llama", debug=False):
+    def __init__(self, name="llama", debug=False, max_concurrency=MAX_CONCURRENT_QUERIES):
         super().__init__(name)
 
         import together
@@ -444,21 +689,35 @@ class Llama3AlignmentScorer(BaseAlignmentScorer):
 
         self.prompt_prefix = PROMPT
         self.client = Together(api_key=os.environ.get("TOGETHER_API_KEY"))
-        self.api_error = error.APIError
+        # only transient errors are retried; others (e.g. a bad request) would fail the same way every time
+        self.retry_errors = (error.RateLimitError, error.Timeout, error.APIConnectionError, error.ServiceUnavailableError)
+        # the table pairs are scored from a pool of threads (see run_eval), so this bounds how many of their
+        # requests are sent to Together at once, however many threads there are
+        self.metadata["max_concurrency"] = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
         self.debug = debug
         self._together = together
 
     def query_llama(self, prompt, max_tokens=200):
-        response = self.client.chat.completions.create(
-            model="meta-llama/Llama-3-70b-chat-hf",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that answers in JSON.",
-                },
-                {"role": "user", "content": prompt}],
-            max_tokens=max_tokens
-        )
+        # rate limits, timeouts, connection errors and unavailable servers are retried with exponential backoff
+        for attempt in range(MAX_RETRIES):
+            try:
+                with self.semaphore:
+                    response = self.client.chat.completions.create(
+                        model="meta-llama/Llama-3-70b-chat-hf",
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": "You are a helpful assistant that answers in JSON.",
+                            },
+                            {"role": "user", "content": prompt}],
+                        max_tokens=max_tokens
+                    )
+                break
+            except self.retry_errors:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                time.sleep(get_backoff_delay(attempt))
         return response
 
     def score_schema_alignments(
@@ -499,15 +758,12 @@ Table 2:
         )
 
         # parse out the json
-        try:
-            response = self.query_llama(prompt)
-        except self.api_error:
-            response = self.query_llama(prompt)
+        response = self.query_llama(prompt)
 
         alignment_str = response.choices[0].message.content
         alignment_str = alignment_str.split("Table 1:\n|")[0]
         try:
-            alignment_json = json.loads(re.search("(\[.+\])", alignment_str, re.DOTALL)[0])
+            alignment_json = extract_json_list(alignment_str)
         except json.JSONDecodeError:
             # try again
             if response.choices[0].finish_reason == self._together.types.common.FinishReason.Length:
@@ -518,7 +774,7 @@ Table 2:
                 print(response)
             alignment_str = response.choices[0].message.content
             alignment_str = alignment_str.split("Table 1:\n|")[0]
-            alignment_json = json.loads(re.search("(\[.+\])", alignment_str, re.DOTALL)[0])
+            alignment_json = extract_json_list(alignment_str)
 
         for gold_col_name in featurized_gold_col_list:
             for pred_col_name in featurized_pred_col_list:
@@ -1,5 +1,8 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+from pathlib import Path
+import sys
 from tqdm import tqdm
 
 from metrics import SchemaRecallMetric
@@ -14,15 +17,33 @@ from metrics_utils import (
 )
 from table import Table
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+
+except ImportError:
+    _loads = json.loads
+
+    def _dumps_line(obj):
+        return (json.dumps(obj) + "\n").encode()
+
+# the list of vague column headers lives with the data processing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data" / "data_processing"))
+from vague_column_headers import vague_column_headers
+
 def open_gold_tables(tables_path):
     """
     Returns a mapping from tabid to gold Table objects
     """
 
     tabid_to_gold_table = {}
-    with open(tables_path) as f:
+    with open(tables_path, "rb") as f:
         for line in f:
-            table_dict = json.loads(line)
+            table_dict = _loads(line)
             tabid = table_dict["tabid"]
             table = Table(
                 tabid=tabid,
@@ -35,9 +56,9 @@ def open_gold_tables(tables_path):
 
 def open_pred_tables(tables_path):
     pred_tables = []
-    with open(tables_path) as f:
+    with open(tables_path, "rb") as f:
         for line in f:
-            table_dict = json.loads(line)
+            table_dict = _loads(line)
             pred_table = Table(
                 tabid=table_dict["metadata"]["tabid"],
                 schema=list(table_dict["table"].keys()),
@@ -47,13 +68,17 @@ def open_pred_tables(tables_path):
             pred_tables.append(table_dict)
     return pred_tables
 
-def load_featurizer(featurizer_name):
+def load_featurizer(featurizer_name, skip_vague_columns=False):
     if featurizer_name == "name":
         return BaseFeaturizer("name")
     elif featurizer_name == "values":
         return ValueFeaturizer("values")
     elif featurizer_name == "decontext":
-        return DecontextFeaturizer("decontext", model="mistralai/Mixtral-8x7B-Instruct-v0.1")
+        return DecontextFeaturizer(
+            "decontext",
+            model="mistralai/Mixtral-8x7B-Instruct-v0.1",
+            skip_column_names=vague_column_headers if skip_vague_columns else None,
+        )
     else:
         raise ValueError(f"Unknown featurizer name: {featurizer_name}.")
 
@@ -76,6 +101,8 @@ def main():
     argp.add_argument("--scorer", type=str, default="sentence_transformers", choices=["exact_match", "jaccard", "sentence_transformers", "llama3"])
     argp.add_argument("--threshold", type=float, default=0.7, help="Threshold used to determine a match for exact_match, jaccard and sentence_transformer scorers")
     argp.add_argument("--eval_type", type=str, default="schema", choices=["schema", "values"])
+    argp.add_argument("--num_workers", type=int, default=16, help="number of tables scored concurrently")
+    argp.add_argument("--skip_vague_columns", action="store_true", help="don't decontextualize vague column headers (e.g. 'Year'), and use their names instead")
     args = argp.parse_args()
 
     # open gold and predicted tables
@@ -83,23 +110,56 @@ def main():
     pred_tables = open_pred_tables(args.pred_tables)
 
     # load the metric
-    featurizer = load_featurizer(args.featurizer)
+    featurizer = load_featurizer(args.featurizer, skip_vague_columns=args.skip_vague_columns)
     scorer = load_scorer(args.scorer)
     metric = SchemaRecallMetric(featurizer=featurizer, alignment_scorer=scorer, sim_threshold=args.threshold)
 
-    # run the evaluation
-    results = []
-    for pred_table_instance in tqdm(pred_tables):
+    # every table that will be featurized during the run (each gold table once)
+    pred_tables_cls = [pred_table_instance["table_cls"] for pred_table_instance in pred_tables]
+    gold_tabids = dict.fromkeys(pred_table.tabid for pred_table in pred_tables_cls)
+    run_tables = pred_tables_cls + [tabid_to_gold_table[tabid] for tabid in gold_tabids]
+
+    # decontextualize the columns of every table in the run up front, so all of their queries are sent concurrently
+    if isinstance(featurizer, DecontextFeaturizer):
+        featurizer.prefetch(run_tables)
+
+    # embed all of the run's featurized columns in large batches, rather than a pair of tables at a time
+    if isinstance(scorer, SentenceTransformerAlignmentScorer) and args.eval_type == "schema":
+        featurized_columns = []
+        for table in run_tables:
+            featurized_columns.extend(featurizer.featurize(list(table.schema), table))
+        scorer.encode(featurized_columns, batch_size=256, show_progress_bar=True)
+
+    # run the evaluation. The tables are scored in a pool of threads, so scorers that wait on an API overlap their
+    # requests. The results are kept in the same order as the predicted tables
+    def score_table(pred_table_instance):
         pred_table = pred_table_instance.pop("table_cls")
         gold_table = tabid_to_gold_table[pred_table.tabid]
         recall, _, alignment = metric.add(pred_table, gold_table, return_scores=True)
         alignment_str_keys = dict(zip(map(str, alignment), alignment.values()))
-        results.append(pred_table_instance | {"scores": {"recall": recall, "alignment": alignment_str_keys, "featurizer": args.featurizer, "scorer": args.scorer, "threshold": args.threshold}})
+        return pred_table_instance | {"scores": {"recall": recall, "alignment": alignment_str_keys, "featurizer": args.featurizer, "scorer": args.scorer, "threshold": args.threshold}}
+
+    executor = ThreadPoolExecutor(max_workers=args.num_workers)
+    try:
+        futures = [executor.submit(score_table, pred_table_instance) for pred_table_instance in pred_tables]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            # raise any errors right away
+            future.result()
+    finally:
+        # after a failure (or ctrl-c), drop the tables that haven't started rather than scoring them all first
+        executor.shutdown(cancel_futures=True)
+    results = [future.result() for future in futures]
+    # don't write scores computed on a mix of decontextualized and raw column names
+    if isinstance(featurizer, DecontextFeaturizer) and featurizer.num_fallback_columns:
+        raise RuntimeError(
+            f"Failed to decontextualize {featurizer.num_fallback_columns} columns, so the results weren't saved. "
+            "Re-run to retry them."
+        )
     
     # write the results to disk
-    with open(args.out_file, "w") as f:
+    with open(args.out_file, "wb") as f:
         for result in results:
-            f.write(json.dumps(result) + "\n")
+            f.write(_dumps_line(result))
         
     scores_dict = metric.process_scores()
 